@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Times attribute and item access on SanicContext objects.
+
+Each operation is run on a SanicContext, and on a SanicContext subclass that
+checks attribute names against its slots with the _iter_slots() generator,
+the way HierDict did before the slot names were precomputed, and on a
+frozen view (with an overlay) of the SanicContext, and on a keyed context,
+which has descriptors for its well-known keys, like the realm gives to plugin
+contexts. The contexts are laid out like a plugin's: a plugin context, with
+the shared context as its parent.
+
+Usage:
+    python -m benchmarks.context_access --output results.json
+"""
+import argparse
+import json
+import platform
+import sys
+
+from timeit import Timer
+
+from sanic import __version__ as sanic_version
+
+from sanic_plugin_toolkit import __version__ as sptk_version
+from sanic_plugin_toolkit.context import HierDict, SanicContext, keyed_context_class
+
+
+class SlotScanContext(SanicContext):
+    """Looks up slot names like HierDict used to, for comparison."""
+
+    __slots__ = ()
+
+    def __getattr__(self, item):
+        if item in self._iter_slots():
+            return object.__getattribute__(self, item)
+        try:
+            return self.__getitem__(item)
+        except KeyError as e:
+            raise AttributeError(*e.args)
+
+    def __setattr__(self, key, value):
+        if key in self._iter_slots():
+            return object.__setattr__(self, key, value)
+        return self.__setitem__(key, value)
+
+
+VARIANTS = ('slot_set', 'slot_scan', 'frozen', 'keyed')
+
+# name -> statement, run against `context`
+OPERATIONS = {
+    'attr_get': "context.user",
+    'attr_set': "context.user = 1",
+    'attr_get_inherited': "context.app",
+    'item_get': "context['user']",
+    'item_set': "context['user'] = 1",
+}
+
+
+def build_context(variant):
+    if variant == 'keyed':
+        shared = keyed_context_class('BenchSharedContext', {'app': None})(None, None, {'app': object()})
+        context = keyed_context_class('BenchContext', {'shared': None, 'user': None, 'app': None})(
+            None, shared, {'shared': shared}
+        )
+        context['user'] = 0
+        return context
+    context_class = SlotScanContext if variant == 'slot_scan' else SanicContext
+    shared = context_class(None, None, {'app': object()})
+    context = context_class(None, shared, {'shared': shared})
+    context['user'] = 0
+    if variant == 'frozen':
+        return context.freeze(overlay=True)
+    return context
+
+
+def time_operation(statement, context, number, repeat):
+    timer = Timer(statement, globals={'context': context})
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+
+def run(number, repeat, variants=VARIANTS):
+    results = []
+    for variant in variants:
+        context = build_context(variant)
+        for operation, statement in OPERATIONS.items():
+            # lookup caches are only valid for one generation, start every run the same way
+            HierDict._generation += 1
+            ns = time_operation(statement, context, number, repeat)
+            results.append({'variant': variant, 'operation': operation, 'ns_per_op': ns})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=200000, help="operations per timing run")
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per operation, the best one is kept")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    results = run(args.number, args.repeat)
+    report = {
+        'benchmark': 'context_access',
+        'sptk_version': sptk_version,
+        'sanic_version': sanic_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    for r in results:
+        print("{variant:10s} {operation:20s} {ns_per_op:8.1f}ns".format(**r))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+Times HierDict and SanicContext operations, and checks how they scale.
+
+The timings cover get, set, contains, replace, update and get() on a
+context at the end of a chain of 1 to 10 contexts, with the key in the
+first one, by item and by attribute, and pickling the chain, and making
+child contexts with create_child_context().
+
+The scaling checks time each operation at a few sizes, fit the exponent
+of its time against the size, and fail if it is more than the operation
+should have. A lookup that looks through its parents is O(depth), so if
+something makes it O(depth^2), the way a list of the parents searched
+so far for a cycle check once did, the check fails.
+
+The results can be saved as a JSON baseline, and later runs compared
+with it.
+
+Usage:
+    python -m benchmarks.context_complexity --output baseline.json
+    python -m benchmarks.context_complexity --check --baseline baseline.json
+"""
+import argparse
+import json
+import math
+import pickle
+import platform
+import sys
+
+from timeit import Timer
+
+from sanic import __version__ as sanic_version
+
+from sanic_plugin_toolkit import __version__ as sptk_version
+from sanic_plugin_toolkit.context import HierDict, SanicContext
+
+
+DEPTHS = tuple(range(1, 11))
+
+# name -> (access, statement), run against `context`, the last context in the chain
+OPERATIONS = {
+    'get': (
+        ('item', "context['root_key']"),
+        ('attr', "context.root_key"),
+    ),
+    'set': (
+        ('item', "context['own_key'] = 1"),
+        ('attr', "context.own_key = 1"),
+    ),
+    'contains': (('item', "'root_key' in context"),),
+    'replace': (('method', "context.replace('root_key', 1)"),),
+    'update': (('method', "context.update(root_key=1, own_key=1)"),),
+    'get_method': (('method', "context.get('root_key')"),),
+    'pickle': (('method', "pickle.dumps(context)"),),
+    'create_child_context': (('method', "context.create_child_context()"),),
+}
+
+
+def build_chain(depth, root_items=None):
+    """
+    :return: the last of `depth` SanicContexts, each the parent of the next
+    :rtype: SanicContext
+    """
+    context = SanicContext(None, None, root_items if root_items is not None else {'root_key': 0})
+    for _ in range(depth - 1):
+        context = context.create_child_context()
+    return context
+
+
+def time_statement(statement, context, repeat, min_time=0.01):
+    timer = Timer(statement, globals={'context': context, 'pickle': pickle})
+    number = _calibrate(timer, min_time)
+    best = min(timer.repeat(repeat=repeat, number=number))
+    return best / number * 1e9
+
+
+def run(repeat, depths=DEPTHS):
+    results = []
+    for operation, accesses in OPERATIONS.items():
+        for access, statement in accesses:
+            for depth in depths:
+                context = build_chain(depth)
+                # lookup caches are only valid for one generation, start every run the same way
+                HierDict._generation += 1
+                ns = time_statement(statement, context, repeat)
+                results.append({'operation': operation, 'access': access, 'depth': depth, 'ns_per_op': ns})
+    return results
+
+
+def _check_get_uncached(n):
+    context = build_chain(n)
+
+    def op():
+        # a new generation throws away the lookup cache, so this walks every parent
+        HierDict._generation += 1
+        return context['root_key']
+
+    return op
+
+
+def _check_get_cached(n):
+    context = build_chain(n)
+    return lambda: context['root_key']
+
+
+def _check_contains(n):
+    context = build_chain(n)
+    return lambda: 'root_key' in context
+
+
+def _check_set(n):
+    context = build_chain(n)
+    return lambda: context.__setitem__('own_key', 1)
+
+
+def _check_replace(n):
+    context = build_chain(n)
+    return lambda: context.replace('root_key', 1)
+
+
+def _check_update(n):
+    keys = ['key{}'.format(i) for i in range(n)]
+    context = build_chain(10, dict.fromkeys(keys, 0))
+    values = dict.fromkeys(keys, 1)
+    return lambda: context.update(values)
+
+
+def _check_reparent(n):
+    context = build_chain(n)
+    orphan = SanicContext(None, None)
+
+    def op():
+        # the cycle check looks at every parent as deep as the orphan, so all of them
+        orphan.reparent(context)
+        orphan.reparent(None)
+
+    return op
+
+
+def _check_create_child_context(n):
+    context = build_chain(1)
+
+    def op():
+        children = [context.create_child_context() for _ in range(n)]
+        del children[:]
+
+    return op
+
+
+def _check_pickle(n):
+    context = build_chain(n)
+    return lambda: pickle.dumps(context)
+
+
+# name -> (make an operation for size n, sizes, the most the exponent of its time can be)
+# The O(n) checks use big enough sizes that an O(n^2) part would stand out from the fixed costs
+SCALING_CHECKS = {
+    'get_inherited_uncached': (_check_get_uncached, (100, 400, 1600), 1.5),
+    'get_inherited_cached': (_check_get_cached, (25, 100, 400), 0.5),
+    'contains': (_check_contains, (25, 100, 400), 0.5),
+    'set': (_check_set, (25, 100, 400), 0.5),
+    'replace_inherited': (_check_replace, (100, 400, 1600), 1.5),
+    'update_keys': (_check_update, (100, 400, 1600), 1.5),
+    'reparent': (_check_reparent, (100, 400, 1600), 1.5),
+    'create_child_contexts': (_check_create_child_context, (250, 1000, 4000), 1.5),
+    'pickle_chain': (_check_pickle, (10, 40, 160), 1.5),
+}
+
+
+def time_call(func, repeat, min_time=0.005):
+    """
+    :return: the best time of one call of func, in seconds
+    :rtype: float
+    """
+    timer = Timer(func)
+    number = _calibrate(timer, min_time)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def _calibrate(timer, min_time):
+    """
+    :return: how many runs of the timer take at least min_time seconds
+    :rtype: int
+    """
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return number
+
+
+def fit_exponent(sizes, seconds):
+    """
+    :return: the slope of log(seconds) against log(sizes), by least squares
+    :rtype: float
+    """
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(t) for t in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    covariance = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    variance = sum((x - x_mean) ** 2 for x in xs)
+    return covariance / variance
+
+
+def run_scaling(repeat, checks=None):
+    results = []
+    for name, (make_op, sizes, max_exponent) in SCALING_CHECKS.items():
+        if checks and name not in checks:
+            continue
+        seconds = [time_call(make_op(n), repeat) for n in sizes]
+        exponent = fit_exponent(sizes, seconds)
+        results.append(
+            {
+                'check': name,
+                'sizes': list(sizes),
+                'seconds': seconds,
+                'exponent': exponent,
+                'max_exponent': max_exponent,
+                'ok': exponent <= max_exponent,
+            }
+        )
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """
+    :return: the timings that are more than `tolerance` times slower than in the baseline
+    :rtype: list
+    """
+    baseline_ns = {(r['operation'], r['access'], r['depth']): r['ns_per_op'] for r in baseline.get('results', ())}
+    slower = []
+    for r in results:
+        before = baseline_ns.get((r['operation'], r['access'], r['depth']), None)
+        if before and r['ns_per_op'] > before * tolerance:
+            slower.append(dict(r, baseline_ns_per_op=before))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5, help="timing runs per operation, the best one is kept")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file")
+    parser.add_argument('--baseline', default=None, help="compare with the JSON results in this file")
+    parser.add_argument('--tolerance', type=float, default=2.0, help="how many times slower than the baseline fails")
+    parser.add_argument('--check', action='store_true', help="exit with 1 if a scaling or baseline check fails")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeat)
+    scaling = run_scaling(args.repeat)
+    report = {
+        'benchmark': 'context_complexity',
+        'sptk_version': sptk_version,
+        'sanic_version': sanic_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+        'scaling': scaling,
+    }
+    for r in results:
+        print("{operation:20s} {access:6s} depth={depth:<3d} {ns_per_op:9.1f}ns".format(**r))
+    for s in scaling:
+        print(
+            "{check:24s} exponent={exponent:5.2f} (max {max_exponent:.1f}) {status}".format(
+                status='ok' if s['ok'] else 'FAILED', **s
+            )
+        )
+    failed = [s['check'] for s in scaling if not s['ok']]
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare_with_baseline(results, baseline, args.tolerance)
+        for r in slower:
+            print(
+                "{operation:20s} {access:6s} depth={depth:<3d} {ns_per_op:9.1f}ns, "
+                "was {baseline_ns_per_op:.1f}ns in the baseline".format(**r)
+            )
+        failed.extend("{operation}/{access}/{depth}".format(**r) for r in slower)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.check and failed:
+        print("Failed: {}".format(', '.join(failed)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
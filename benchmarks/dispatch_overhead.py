@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Measures how much the Sanic Plugin Toolkit adds to the cost of dispatching a
+request, compared to the same app without a realm.
+
+Each app is driven in-process through its ASGI interface, so every request
+goes through the realm-patched handle_request, but no sockets are involved.
+The sweep covers 0, 1, 5, 20 and 50 registered plugins, on an app realm and
+on a Blueprint realm, with plain routes and with SanicPlugin.decorate routes.
+Every plugin registers a request middleware (cycling through sync, async,
+and their with_context versions) and a sync response middleware.
+peak_traced_bytes_per_request is the median, over the traced requests, of
+the peak memory tracemalloc saw during one request. That is the most the
+request held at once, not the total it allocated.
+
+Usage:
+    python -m benchmarks.dispatch_overhead --output results.json
+
+The results are written as JSON, so runs from different releases can be
+compared with each other.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import sys
+import tracemalloc
+import warnings
+
+from itertools import count
+from time import perf_counter
+
+from sanic import Blueprint, Sanic
+from sanic import __version__ as sanic_version
+from sanic.response import text
+
+from sanic_plugin_toolkit import SanicPlugin, SanicPluginRealm
+from sanic_plugin_toolkit import __version__ as sptk_version
+
+
+PLUGIN_COUNTS = (0, 1, 5, 20, 50)
+REALM_KINDS = ('app', 'blueprint')
+ROUTE_KINDS = ('route', 'decorate')
+
+_app_ids = count()
+
+
+class BenchPlugin(SanicPlugin):
+    pass
+
+
+class BenchDecorate(SanicPlugin):
+    pass
+
+
+# SanicPlugin.decorate() finds the plugin instance by its snake_case name
+bench_decorate = BenchDecorate()
+
+
+@bench_decorate.middleware(with_context=True)
+def bench_decorate_mw(request, context):
+    context['seen'] = True
+
+
+def _sync_mw(request):
+    return None
+
+
+async def _async_mw(request):
+    return None
+
+
+def _sync_ctx_mw(request, context):
+    context['seen'] = True
+
+
+async def _async_ctx_mw(request, context):
+    context['seen'] = True
+
+
+def _response_mw(request, response):
+    return None
+
+
+# (request middleware, with_context), cycled through by the plugins
+MIDDLEWARE_MIX = ((_sync_mw, False), (_async_mw, False), (_sync_ctx_mw, True), (_async_ctx_mw, True))
+
+
+async def _handler(request):
+    return text('OK')
+
+
+async def _context_handler(request, context):
+    return text('OK')
+
+
+def build_app(plugins, realm_kind, route_kind, vanilla=False):
+    """
+    Build an app for one point of the sweep.
+    :return: the app, and the path to request on it
+    :rtype: tuple
+    """
+    app = Sanic('sptk_bench_{}'.format(next(_app_ids)))
+    target = Blueprint('bench_bp', url_prefix='/bp') if realm_kind == 'blueprint' else app
+    path = '/bp/' if realm_kind == 'blueprint' else '/'
+    if vanilla:
+        target.route('/')(_handler)
+    else:
+        realm = SanicPluginRealm(target)
+        for i in range(plugins):
+            plugin = BenchPlugin()
+            (middleware, with_context) = MIDDLEWARE_MIX[i % len(MIDDLEWARE_MIX)]
+            plugin.middleware(with_context=with_context)(middleware)
+            plugin.middleware(attach_to='response')(_response_mw)
+            realm.register_plugin(plugin, name='BenchPlugin{}'.format(i))
+        if route_kind == 'decorate':
+            handler = BenchDecorate.decorate(target, run_middleware=True, with_context=True)(_context_handler)
+            target.route('/')(handler)
+        else:
+            target.route('/')(_handler)
+    if realm_kind == 'blueprint':
+        app.blueprint(target)
+    return app, path
+
+
+class AsgiDriver(object):
+    """Sends requests straight into an app's ASGI interface."""
+
+    def __init__(self, app):
+        self.app = app
+        self._lifespan_events = None
+        self._lifespan_sent = None
+        self._lifespan_task = None
+
+    async def start(self):
+        self._lifespan_events = asyncio.Queue()
+        self._lifespan_sent = asyncio.Queue()
+        scope = {'type': 'lifespan', 'asgi': {'version': '3.0'}}
+        self._lifespan_task = asyncio.ensure_future(
+            self.app(scope, self._lifespan_events.get, self._lifespan_sent.put)
+        )
+        await self._lifespan_events.put({'type': 'lifespan.startup'})
+        message = await self._lifespan_sent.get()
+        assert message['type'] == 'lifespan.startup.complete', message
+
+    async def stop(self):
+        await self._lifespan_events.put({'type': 'lifespan.shutdown'})
+        _ = await self._lifespan_sent.get()  # noqa: F841
+        # Some Sanic versions go on to treat the lifespan scope as a request,
+        # and fail, after the shutdown is complete. That can be ignored here.
+        _ = await asyncio.gather(self._lifespan_task, return_exceptions=True)  # noqa: F841
+
+    async def get(self, path):
+        scope = {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode('latin-1'),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'bench.local')],
+            'client': ('127.0.0.1', 50000),
+            'server': ('127.0.0.1', 80),
+        }
+        status = None
+
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+
+        await self.app(scope, receive, send)
+        return status
+
+
+def _percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def measure(app, path, requests, warmup, alloc_samples):
+    driver = AsgiDriver(app)
+    await driver.start()
+    try:
+        for _ in range(warmup):
+            status = await driver.get(path)
+            assert status == 200, "Benchmark request failed with status {}".format(status)
+        latencies = []
+        gc.collect()
+        start = perf_counter()
+        for _ in range(requests):
+            t = perf_counter()
+            _ = await driver.get(path)  # noqa: F841
+            latencies.append(perf_counter() - t)
+        elapsed = perf_counter() - start
+        # Peak traced memory during one request, how much it allocates on the way
+        alloc_peaks = []
+        for _ in range(alloc_samples):
+            tracemalloc.start()
+            _ = await driver.get(path)  # noqa: F841
+            alloc_peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    finally:
+        await driver.stop()
+    latencies.sort()
+    return {
+        'requests': requests,
+        'rps': requests / elapsed,
+        'p50_ms': _percentile(latencies, 0.50) * 1000.0,
+        'p99_ms': _percentile(latencies, 0.99) * 1000.0,
+        'peak_traced_bytes_per_request': statistics.median(alloc_peaks) if alloc_peaks else None,
+    }
+
+
+def run_sweep(requests, warmup, alloc_samples, plugin_counts=PLUGIN_COUNTS):
+    # Many apps are started in this one process. Like sanic-testing, use test
+    # mode so Sanic's TouchUp starts from the original methods for each app.
+    Sanic.test_mode = True
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    try:
+        for realm_kind in REALM_KINDS:
+            app, path = build_app(0, realm_kind, 'route', vanilla=True)
+            baseline = loop.run_until_complete(measure(app, path, requests, warmup, alloc_samples))
+            baseline.update({'realm': realm_kind, 'route': 'route', 'plugins': None, 'vanilla': True})
+            results.append(baseline)
+            for route_kind in ROUTE_KINDS:
+                for plugins in plugin_counts:
+                    app, path = build_app(plugins, realm_kind, route_kind)
+                    result = loop.run_until_complete(measure(app, path, requests, warmup, alloc_samples))
+                    result.update({'realm': realm_kind, 'route': route_kind, 'plugins': plugins, 'vanilla': False})
+                    result['rps_vs_vanilla'] = result['rps'] / baseline['rps']
+                    results.append(result)
+    finally:
+        loop.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=2000, help="timed requests per configuration")
+    parser.add_argument('--warmup', type=int, default=200, help="untimed requests per configuration")
+    parser.add_argument('--alloc-samples', type=int, default=20, help="requests traced for allocations")
+    parser.add_argument('--plugins', type=int, nargs='*', default=list(PLUGIN_COUNTS), help="plugin counts to sweep")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    # Realm listeners are registered on before_server_start, which ASGI mode warns about
+    warnings.simplefilter('ignore')
+    results = run_sweep(args.requests, args.warmup, args.alloc_samples, tuple(args.plugins))
+    report = {
+        'benchmark': 'dispatch_overhead',
+        'sptk_version': sptk_version,
+        'sanic_version': sanic_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    for r in results:
+        print(
+            "{realm:9s} {route:8s} plugins={plugins!s:4s} rps={rps:9.1f} p50={p50_ms:.3f}ms p99={p99_ms:.3f}ms "
+            "peak_traced={peak_traced_bytes_per_request}B".format(**r)
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
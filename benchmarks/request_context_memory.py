@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Measures the memory held by request contexts with many requests in flight.
+
+The app is started, then request contexts are made for `--in-flight`
+requests at once (10000 by default), without finishing any of them. Each
+plugin writes a few keys to its private request context, and one to the
+shared request context, the way request middleware would. The benchmark
+reports the bytes held per in-flight request, with
+SPTK_REQUEST_CONTEXT_SHARED_KEYS unset and set, for each plugin count.
+The requests themselves are made before the measurement, so only the
+request contexts (with the realm's and the requests' references to them)
+are counted.
+
+Usage:
+    python -m benchmarks.request_context_memory --output results.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import sys
+import tracemalloc
+import warnings
+
+from itertools import count
+
+from sanic import Sanic
+from sanic import __version__ as sanic_version
+from sanic.request import Request
+from sanic.response import text
+
+from benchmarks.dispatch_overhead import AsgiDriver
+from sanic_plugin_toolkit import SanicPlugin, SanicPluginRealm
+from sanic_plugin_toolkit import __version__ as sptk_version
+
+
+PLUGIN_COUNTS = (1, 5, 20)
+IN_FLIGHT = 10000
+
+_app_ids = count()
+
+
+class MemoryBenchPlugin(SanicPlugin):
+    pass
+
+
+async def _handler(request):
+    return text('OK')
+
+
+def build_app(plugins, shared_keys):
+    app = Sanic('sptk_memory_bench_{}'.format(next(_app_ids)))
+    app.config['SPTK_REQUEST_CONTEXT_SHARED_KEYS'] = shared_keys
+    realm = SanicPluginRealm(app)
+    for i in range(plugins):
+        realm.register_plugin(MemoryBenchPlugin(), name='MemoryBenchPlugin{}'.format(i))
+    app.route('/')(_handler)
+    return app, realm
+
+
+def fill_request_contexts(realm, requests):
+    contexts = [realm.get_context(name) for name in sorted(realm._plugin_names)]
+    for request in requests:
+        shared_request = realm.create_temporary_request_context(request)
+        shared_request['user'] = "alice"
+        for context in contexts:
+            private_request = context.for_request(request)
+            private_request['seen'] = True
+            private_request['token'] = "abc"
+            private_request['started'] = 0.0
+
+
+async def measure(app, realm, in_flight):
+    driver = AsgiDriver(app)
+    await driver.start()
+    try:
+        requests = [Request(b'/', {}, '1.1', 'GET', None, app) for _ in range(in_flight)]
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        fill_request_contexts(realm, requests)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        live = realm.live_request_contexts()
+        for request in requests:
+            realm.delete_temporary_request_context(request)
+    finally:
+        await driver.stop()
+    return {
+        'in_flight': in_flight,
+        'live_request_contexts': live,
+        'bytes_per_request': held / in_flight,
+    }
+
+
+def run_sweep(in_flight, plugin_counts=PLUGIN_COUNTS):
+    # See dispatch_overhead.run_sweep, many apps are started in this process
+    Sanic.test_mode = True
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    try:
+        for plugins in plugin_counts:
+            for shared_keys in (False, True):
+                app, realm = build_app(plugins, shared_keys)
+                result = loop.run_until_complete(measure(app, realm, in_flight))
+                result.update({'plugins': plugins, 'shared_keys': shared_keys})
+                results.append(result)
+    finally:
+        loop.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--in-flight', type=int, default=IN_FLIGHT, help="requests with live contexts at once")
+    parser.add_argument('--plugins', type=int, nargs='*', default=list(PLUGIN_COUNTS), help="plugin counts to sweep")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    results = run_sweep(args.in_flight, tuple(args.plugins))
+    report = {
+        'benchmark': 'request_context_memory',
+        'sptk_version': sptk_version,
+        'sanic_version': sanic_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    for r in results:
+        print(
+            "plugins={plugins:<3d} shared_keys={shared_keys!s:5s} in_flight={live_request_contexts:<6d} "
+            "{bytes_per_request:8.1f}B/request".format(**r)
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
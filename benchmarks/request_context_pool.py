@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Compares request context churn with and without the request context pool.
+
+Every plugin registers a with_context request middleware that writes to its
+private request context, so each request creates one shared request context
+and one private request context per plugin. The app is run with
+SPTK_REQUEST_CONTEXT_POOL_SIZE unset and set, in dict mode and in
+contextvars mode, and for each run the benchmark reports the throughput,
+the peak traced memory of one request, and the number of generation 0
+garbage collections per 1000 requests.
+
+Usage:
+    python -m benchmarks.request_context_pool --output results.json
+"""
+import argparse
+import asyncio
+import gc
+import json
+import platform
+import statistics
+import sys
+import tracemalloc
+import warnings
+
+from itertools import count
+from time import perf_counter
+
+from sanic import Sanic
+from sanic import __version__ as sanic_version
+from sanic.response import text
+
+from benchmarks.dispatch_overhead import AsgiDriver
+from sanic_plugin_toolkit import SanicPlugin, SanicPluginRealm
+from sanic_plugin_toolkit import __version__ as sptk_version
+
+
+PLUGIN_COUNTS = (1, 5, 20)
+POOL_SIZES = (0, 256)
+CONTEXT_MODES = ('dict', 'contextvars')
+
+_app_ids = count()
+
+
+class PoolBenchPlugin(SanicPlugin):
+    pass
+
+
+def _ctx_mw(request, context):
+    context.for_request(request)['seen'] = True
+
+
+async def _handler(request):
+    return text('OK')
+
+
+def build_app(plugins, pool_size, mode):
+    app = Sanic('sptk_pool_bench_{}'.format(next(_app_ids)))
+    app.config['SPTK_REQUEST_CONTEXT_POOL_SIZE'] = pool_size
+    app.config['SPTK_REQUEST_CONTEXT_POOL_DEBUG'] = False
+    app.config['SPTK_REQUEST_CONTEXTVARS'] = mode == 'contextvars'
+    realm = SanicPluginRealm(app)
+    for i in range(plugins):
+        plugin = PoolBenchPlugin()
+        plugin.middleware(with_context=True)(_ctx_mw)
+        realm.register_plugin(plugin, name='PoolBenchPlugin{}'.format(i))
+    app.route('/')(_handler)
+    return app
+
+
+async def measure(app, requests, warmup, alloc_samples):
+    driver = AsgiDriver(app)
+    await driver.start()
+    try:
+        for _ in range(warmup):
+            status = await driver.get('/')
+            assert status == 200, "Benchmark request failed with status {}".format(status)
+        gc.collect()
+        gen0_before = gc.get_stats()[0]['collections']
+        start = perf_counter()
+        for _ in range(requests):
+            _ = await driver.get('/')  # noqa: F841
+        elapsed = perf_counter() - start
+        gen0_collections = gc.get_stats()[0]['collections'] - gen0_before
+        alloc_peaks = []
+        for _ in range(alloc_samples):
+            tracemalloc.start()
+            _ = await driver.get('/')  # noqa: F841
+            alloc_peaks.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+    finally:
+        await driver.stop()
+    return {
+        'requests': requests,
+        'rps': requests / elapsed,
+        'gen0_collections_per_1000': gen0_collections * 1000.0 / requests,
+        'peak_traced_bytes_per_request': statistics.median(alloc_peaks) if alloc_peaks else None,
+    }
+
+
+def run_sweep(requests, warmup, alloc_samples, plugin_counts=PLUGIN_COUNTS):
+    # See dispatch_overhead.run_sweep, many apps are started in this process
+    Sanic.test_mode = True
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    results = []
+    try:
+        for mode in CONTEXT_MODES:
+            for plugins in plugin_counts:
+                for pool_size in POOL_SIZES:
+                    app = build_app(plugins, pool_size, mode)
+                    result = loop.run_until_complete(measure(app, requests, warmup, alloc_samples))
+                    result.update({'mode': mode, 'plugins': plugins, 'pool_size': pool_size})
+                    results.append(result)
+    finally:
+        loop.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000, help="timed requests per configuration")
+    parser.add_argument('--warmup', type=int, default=500, help="untimed requests per configuration")
+    parser.add_argument('--alloc-samples', type=int, default=20, help="requests traced for allocations")
+    parser.add_argument('--plugins', type=int, nargs='*', default=list(PLUGIN_COUNTS), help="plugin counts to sweep")
+    parser.add_argument('--output', default=None, help="write the JSON results to this file")
+    args = parser.parse_args(argv)
+
+    warnings.simplefilter('ignore')
+    results = run_sweep(args.requests, args.warmup, args.alloc_samples, tuple(args.plugins))
+    report = {
+        'benchmark': 'request_context_pool',
+        'sptk_version': sptk_version,
+        'sanic_version': sanic_version,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'results': results,
+    }
+    for r in results:
+        print(
+            "{mode:11s} plugins={plugins:<3d} pool={pool_size:<4d} rps={rps:9.1f} "
+            "gen0/1000={gen0_collections_per_1000:6.2f} peak_traced={peak_traced_bytes_per_request}B".format(**r)
+        )
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,6 +5,32 @@ to manage Context objects. It can be hierarchical, and it searches its
 parents if it cannot find an item in its own dictionary. It can create its
 own children.
 """
+from collections import namedtuple
+from collections.abc import MutableMapping
+from weakref import WeakSet, WeakValueDictionary
+
+
+# Stands for a key that a dict.get() didn't find, where None can be a value
+_UNCACHED = object()
+
+# What a realm in contextvars mode binds to the running request's context
+RequestContextBinding = namedtuple('RequestContextBinding', ['request', 'shared', 'private'])
+
+
+class RequestContextAnchor(object):
+    """
+    Kept on request.ctx, this is what holds a request's contexts for one
+    realm. The realm's own dicts only hold them weakly, so they can't
+    outlive the request, even if they are never deleted.
+    """
+
+    __slots__ = ('created', 'shared', 'private')
+
+    def __init__(self, created, shared):
+        self.created = created
+        self.shared = shared
+        # (plugin request contexts dict, private request context) pairs
+        self.private = []
 
 
 class HierDict(object):
@@ -15,23 +41,24 @@ class HierDict(object):
     own children.
     """
 
-    __slots__ = ('_parent_hd', '_dict', '__weakref__')
+    __slots__ = ('_parent_hd', '_dict', '_children', '_depth', '_lookup_cache', '__weakref__')
+
+    # Bumped by every change to a HierDict that has children, and by every
+    # re-parenting. A lookup cache is only used while its generation is current.
+    _generation = 0
 
     @classmethod
     def _iter_slots(cls):
-        use_cls = cls
-        bases = cls.__bases__
-        base_count = 0
-        while True:
-            if use_cls.__slots__:
-                for _s in use_cls.__slots__:
-                    yield _s
-            if base_count >= len(bases):
-                break
-            use_cls = bases[base_count]
-            base_count += 1
+        for use_cls in cls.__mro__:
+            for _s in use_cls.__dict__.get('__slots__', ()):
+                yield _s
         return
 
+    def __init_subclass__(cls, **kwargs):
+        super(HierDict, cls).__init_subclass__(**kwargs)
+        # Attribute access checks this on every get and set, so work it out once
+        cls._slot_names = frozenset(cls._iter_slots())
+
     def _inner(self):
         """
         :return: the internal dictionary
@@ -50,33 +77,54 @@ class HierDict(object):
     def __len__(self):
         return len(self._inner())
 
+    def _changed(self):
+        """
+        Call this before changing the keys of this HierDict. The children's
+        lookup caches can point past it, so they are made out of date.
+        Subclasses that keep keys somewhere else must call it too.
+        """
+        if self._children is not None:
+            HierDict._generation += 1
+
     def __setitem__(self, key, value):
         # TODO: If key is in __slots__, ignore it and return
+        self._changed()
         return self._inner().__setitem__(key, value)
 
     def __getitem__(self, item):
         try:
             return self._inner().__getitem__(item)
         except KeyError as e1:
-            parents_searched = [self]
             parent = self._parent_hd
-            while parent:
+            if parent is None:
+                raise
+            cache = self._lookup_cache
+            if cache is None or cache[0] != HierDict._generation:
+                self._lookup_cache = cache = (HierDict._generation, {})
+            else:
+                resolved = cache[1].get(item, None)
+                if resolved is not None:
+                    return resolved[item]
+            # Parents can't make a cycle, see _link_parent()
+            while parent is not None:
+                parent_dict = parent._inner()
                 try:
-                    return parent._inner().__getitem__(item)
+                    value = parent_dict.__getitem__(item)
                 except KeyError:
-                    parents_searched.append(parent)
                     # noinspection PyProtectedMember
-                    next_parent = parent._parent_hd
-                    if next_parent in parents_searched:
-                        raise RuntimeError("Recursive HierDict found!")
-                    parent = next_parent
+                    parent = parent._parent_hd
+                else:
+                    cache[1][item] = parent_dict
+                    return value
+            # Misses aren't cached, so the cache can't grow past the keys the parents have
             raise e1
 
     def __delitem__(self, key):
+        self._changed()
         self._inner().__delitem__(key)
 
     def __getattr__(self, item):
-        if item in self._iter_slots():
+        if item in self._slot_names:
             return object.__getattribute__(self, item)
         try:
             return self.__getitem__(item)
@@ -84,12 +132,14 @@ class HierDict(object):
             raise AttributeError(*e.args)
 
     def __setattr__(self, key, value):
-        if key in self._iter_slots():
+        if key in self._slot_names:
             if key == '__weakref__':
                 if value is None:
                     return
                 else:
                     raise ValueError("Cannot set weakrefs on Context")
+            if key == '_parent_hd':
+                return self._link_parent(value)
             return object.__setattr__(self, key, value)
         try:
             return self.__setitem__(key, value)
@@ -97,6 +147,54 @@ class HierDict(object):
             # what exceptions can occur on setting an item?
             raise e
 
+    def reparent(self, parent):
+        """
+        Move this HierDict, with its children, under another parent.
+        :param parent: the new parent, or None to make this a root HierDict
+        :raises RuntimeError: if this HierDict is the new parent, or one of its parents
+        """
+        return self._link_parent(parent)
+
+    def _link_parent(self, parent):
+        if parent is not None:
+            assert isinstance(parent, HierDict), "Parent context must be a valid initialised HierDict"
+            # Only a parent at least as deep as this one can be its descendant
+            ancestor = parent
+            while ancestor is not None and ancestor._depth >= self._depth:
+                if ancestor is self:
+                    raise RuntimeError("Recursive HierDict found!")
+                ancestor = ancestor._parent_hd
+        old_parent = self._parent_hd
+        if old_parent is not None and old_parent._children is not None:
+            old_parent._children.discard(self)
+        self._attach(parent)
+        # Every lookup cache that went through the old parent is out of date now
+        HierDict._generation += 1
+
+    def _attach(self, parent):
+        """
+        Set the parent, and the depth of this HierDict and all of its children.
+        This doesn't check for cycles, see _link_parent().
+        """
+        if parent is None:
+            depth = 0
+        else:
+            children = parent._children
+            if children is None:
+                children = WeakSet()
+                object.__setattr__(parent, '_children', children)
+            children.add(self)
+            depth = parent._depth + 1
+        object.__setattr__(self, '_parent_hd', parent)
+        delta = depth - self._depth
+        if delta:
+            nodes = [self]
+            while nodes:
+                node = nodes.pop()
+                object.__setattr__(node, '_depth', node._depth + delta)
+                if node._children is not None:
+                    nodes.extend(node._children)
+
     def __contains__(self, item):
         return self._inner().__contains__(item)
 
@@ -148,50 +246,77 @@ class HierDict(object):
         """
         if key in self._inner().keys():
             return self.__setitem__(key, value)
-        parents_searched = [self]
         parent = self._parent_hd
-        while parent:
+        while parent is not None:
             try:
                 if key in parent.keys():
                     return parent.__setitem__(key, value)
             except (KeyError, AttributeError):
                 pass
-            parents_searched.append(parent)
             # noinspection PyProtectedMember
-            next_parent = parent._parent_context
-            if next_parent in parents_searched:
-                raise RuntimeError("Recursive HierDict found!")
-            parent = next_parent
+            parent = parent._parent_hd
         return self.__setitem__(key, value)
 
     # noinspection PyPep8Naming
     def update(self, E=None, **F):
         """
-        Update HierDict from dict/iterable E and F
+        Update HierDict from dict/iterable E and F, like replace() does for
+        each key. Where each key goes is worked out in one walk up the
+        parents, then each HierDict that gets keys is updated once.
         :return: Nothing
         :rtype: None
         """
+        pending = {}
         if E is not None:
             if hasattr(E, 'keys'):
                 for K in E:
-                    self.replace(K, E[K])
+                    pending[K] = E[K]
             elif hasattr(E, 'items'):
-                for K, V in E.items():
-                    self.replace(K, V)
+                pending.update(E.items())
             else:
-                for K, V in E:
-                    self.replace(K, V)
-        for K in F:
-            self.replace(K, F[K])
+                pending.update(E)
+        pending.update(F)
+        if not pending:
+            return
+        own = {K: pending.pop(K) for K in [K for K in pending if K in self._inner().keys()]}
+        parent = self._parent_hd
+        while pending and parent is not None:
+            parent_keys = parent.keys()
+            found = {K: pending.pop(K) for K in [K for K in pending if K in parent_keys]}
+            if found:
+                parent._update_own(found)
+            # noinspection PyProtectedMember
+            parent = parent._parent_hd
+        # keys no parent has are set here, like replace() does
+        own.update(pending)
+        if own:
+            self._update_own(own)
+
+    def _update_own(self, values):
+        """
+        Set several keys on this HierDict, not on its parents.
+        :param values: the keys and values
+        :type values: dict
+        """
+        if type(self).__setitem__ is not HierDict.__setitem__:
+            # this subclass keeps some keys somewhere else
+            for K, V in values.items():
+                self.__setitem__(K, V)
+            return
+        self._changed()
+        self._inner().update(values)
 
     def __new__(cls, parent, *args, **kwargs):
         self = super(HierDict, cls).__new__(cls)
         self._dict = dict(*args, **kwargs)
+        self._children = None
+        self._depth = 0
+        self._lookup_cache = None
+        # A new HierDict can't be in a cycle, and has no lookup cache or
+        # children to invalidate, so this doesn't need _link_parent()
         if parent is not None:
             assert isinstance(parent, HierDict), "Parent context must be a valid initialised HierDict"
-            self._parent_hd = parent
-        else:
-            self._parent_hd = None
+        self._attach(parent)
         return self
 
     def __init__(self, *args, **kwargs):
@@ -202,7 +327,8 @@ class HierDict(object):
     def __getstate__(self):
         state_dict = {}
         for s in HierDict.__slots__:
-            if s == "__weakref__":
+            # the links to children, the depth and the cache are made again from the parent
+            if s in ("__weakref__", "_children", "_depth", "_lookup_cache"):
                 continue
             state_dict[s] = object.__getattribute__(self, s)
         return state_dict
@@ -218,6 +344,9 @@ class HierDict(object):
         return (HierDict.__new__, (self.__class__, parent_context), state_dict)
 
 
+HierDict._slot_names = frozenset(HierDict._iter_slots())
+
+
 class SanicContext(HierDict):
     __slots__ = ('_stk_realm',)
 
@@ -261,3 +390,707 @@ class SanicContext(HierDict):
         # shortcut for context.request[id(req)]
         requests_ctx = self.request
         return requests_ctx[id(req)] if req else None
+
+    def snapshot(self):
+        """
+        A copy of this context that can outlive it, like a request context
+        used by a background task after the response. Only the references to
+        its own values are copied. It has the same parent, so the parent's
+        keys are looked up, not copied. Setting a key on one of them doesn't
+        change the other.
+        :return: the new context
+        :rtype: SanicContext
+        """
+        return SanicContext(self._stk_realm, self._parent_hd, self._inner())
+
+    def freeze(self, overlay=False):
+        """
+        A flat, read-only view of this context, with the keys it inherits
+        from its parents, for reading config-like values on the hot path.
+        The view is taken now, later changes to the context don't show in it.
+        :param overlay: if True, keys set on the view go to a dict of its own,
+                        otherwise setting a key raises a TypeError.
+        :return: the view
+        :rtype: FrozenContext
+        """
+        chain = []
+        context = self
+        while context is not None:
+            chain.append(context)
+            context = context._parent_hd
+        flat = {}
+        for context in reversed(chain):
+            flat.update(context.items())
+        return FrozenContext(flat, {} if overlay else None)
+
+
+# FrozenContext reads its own slots with this, bypassing its __getattribute__
+_attr = object.__getattribute__
+
+
+class FrozenContext(object):
+    """
+    A flat, read-only view of a SanicContext and its parents, made by
+    SanicContext.freeze(). Every key is one dict lookup away. If it has an
+    overlay, keys set on it go there, and are read from there first.
+    """
+
+    __slots__ = ('_flat', '_overlay')
+
+    def __init__(self, flat, overlay=None):
+        object.__setattr__(self, '_flat', flat)
+        object.__setattr__(self, '_overlay', overlay)
+
+    def __repr__(self):
+        return "FrozenContext({:s})".format(repr(_attr(self, '_flat')))
+
+    def __str__(self):
+        return "FrozenContext({:s})".format(str(_attr(self, '_flat')))
+
+    def __getitem__(self, item):
+        overlay = _attr(self, '_overlay')
+        if overlay and item in overlay:
+            return overlay[item]
+        return _attr(self, '_flat')[item]
+
+    def __getattribute__(self, item):
+        # Keys are read straight from the dicts, only the view's own
+        # attributes and methods go through the usual lookup
+        if item in _FROZEN_CONTEXT_ATTRS:
+            return _attr(self, item)
+        overlay = _attr(self, '_overlay')
+        if overlay and item in overlay:
+            return overlay[item]
+        try:
+            return _attr(self, '_flat')[item]
+        except KeyError as e:
+            raise AttributeError(*e.args)
+
+    def __setitem__(self, key, value):
+        overlay = _attr(self, '_overlay')
+        if overlay is None:
+            raise TypeError("Cannot set {!r} on a FrozenContext without an overlay.".format(key))
+        overlay[key] = value
+
+    __setattr__ = set = __setitem__
+
+    def __delitem__(self, key):
+        overlay = _attr(self, '_overlay')
+        if overlay is None or key not in overlay:
+            raise TypeError("Cannot delete {!r} from a FrozenContext, only keys set on its overlay.".format(key))
+        del overlay[key]
+
+    def __contains__(self, item):
+        overlay = _attr(self, '_overlay')
+        return item in _attr(self, '_flat') or bool(overlay) and item in overlay
+
+    def _merged(self):
+        overlay = _attr(self, '_overlay')
+        if not overlay:
+            return _attr(self, '_flat')
+        merged = dict(_attr(self, '_flat'))
+        merged.update(overlay)
+        return merged
+
+    def __len__(self):
+        return len(self._merged())
+
+    def __iter__(self):
+        return iter(self._merged())
+
+    def get(self, key, default=None):
+        try:
+            return self.__getitem__(key)
+        except KeyError:
+            return default
+
+    def items(self):
+        return self._merged().items()
+
+    def keys(self):
+        return self._merged().keys()
+
+    def values(self):
+        return self._merged().values()
+
+    def for_request(self, req):
+        # shortcut for context.request[id(req)]
+        return self['request'][id(req)] if req else None
+
+
+_FROZEN_CONTEXT_ATTRS = frozenset(dir(FrozenContext))
+
+
+class RequestContextRegistry(SanicContext):
+    """
+    Holds request contexts keyed by id(request). Those are only held weakly,
+    so a context that is never deleted still goes away with its request.
+    Other keys are kept in the inner dict as usual.
+    """
+
+    __slots__ = ('_live',)
+
+    def __len__(self):
+        return len(self._inner()) + len(self._live)
+
+    def __setitem__(self, key, value):
+        if isinstance(key, int):
+            return self._live.__setitem__(key, value)
+        self._changed()
+        return self._inner().__setitem__(key, value)
+
+    def __getitem__(self, item):
+        if isinstance(item, int):
+            return self._live.__getitem__(item)
+        return super(RequestContextRegistry, self).__getitem__(item)
+
+    def __delitem__(self, key):
+        if isinstance(key, int):
+            return self._live.__delitem__(key)
+        self._changed()
+        return self._inner().__delitem__(key)
+
+    def __contains__(self, item):
+        if isinstance(item, int):
+            return self._live.__contains__(item)
+        return self._inner().__contains__(item)
+
+    def pop_request_context(self, request_hash):
+        return self._live.pop(request_hash, None)
+
+    def __new__(cls, stk_realm, parent, *args, live=None, **kwargs):
+        self = super(RequestContextRegistry, cls).__new__(cls, stk_realm, parent, *args, **kwargs)
+        self._live = WeakValueDictionary() if live is None else live
+        return self
+
+    def __init__(self, *args, live=None, **kwargs):
+        super(RequestContextRegistry, self).__init__(*args, **kwargs)
+
+    def __setstate__(self, state):
+        super(RequestContextRegistry, self).__setstate__(state)
+        # The live request contexts belong to the process that pickled this, start with none
+        self._live = WeakValueDictionary()
+
+
+class PluginRequestContexts(RequestContextRegistry):
+    """
+    Holds one plugin's private request contexts, keyed by id(request).
+    A private request context is only created the first time it is looked
+    up, and only for a request the realm is handling right now.
+    """
+
+    __slots__ = ('_plugin_name', '_context_class')
+
+    def __getitem__(self, item):
+        try:
+            return super(PluginRequestContexts, self).__getitem__(item)
+        except KeyError:
+            context = self._stk_realm._create_private_request_context(self, item)
+            if context is None:
+                raise
+            return context
+
+    def __contains__(self, item):
+        return super(PluginRequestContexts, self).__contains__(item) or self._stk_realm._has_request_context(item)
+
+    def __new__(cls, stk_realm, parent, *args, plugin_name=None, context_class=None, **kwargs):
+        self = super(PluginRequestContexts, cls).__new__(cls, stk_realm, parent, *args, **kwargs)
+        self._plugin_name = plugin_name
+        self._context_class = context_class
+        return self
+
+    def __init__(self, *args, plugin_name=None, context_class=None, **kwargs):
+        super(PluginRequestContexts, self).__init__(*args, **kwargs)
+
+    def __getstate__(self):
+        state_dict = super(PluginRequestContexts, self).__getstate__()
+        for s in PluginRequestContexts.__slots__:
+            state_dict[s] = object.__getattribute__(self, s)
+        context_class = state_dict['_context_class']
+        if context_class is not None:
+            # The class is made at runtime, so it is pickled as its name and fields
+            state_dict['_context_class'] = (context_class.__name__, tuple(sorted(context_class._declared)))
+        return state_dict
+
+    def __setstate__(self, state):
+        context_class = state.get('_context_class', None)
+        if isinstance(context_class, tuple):
+            name, fields = context_class
+            schema = type(name, (object,), {'__slots__': fields})
+            state = dict(state, _context_class=declared_context_class(name, schema))
+        super(PluginRequestContexts, self).__setstate__(state)
+
+
+class SharedRequestContexts(SanicContext):
+    """
+    Stands in for the shared request contexts dict, when the realm keeps
+    request contexts in a ContextVar. Looking up id(request) gives the
+    shared request context bound to the running request, if it has that id.
+    Nothing is stored here per request.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, item):
+        try:
+            return self._inner().__getitem__(item)
+        except KeyError:
+            binding = self._stk_realm._request_context_var.get()
+            if binding is None or id(binding.request) != item:
+                raise
+            return binding.shared
+
+    def __contains__(self, item):
+        return self._inner().__contains__(item) or self._stk_realm._has_request_context(item)
+
+
+class DeclaredContext(SanicContext):
+    """
+    A SanicContext where the declared keys are kept in slots, instead of in
+    the inner dict. Undeclared keys still go to the inner dict. Subclasses
+    are made by declared_context_class(), one for each plugin that has a
+    RequestContext schema.
+    """
+
+    __slots__ = ()
+    _declared = frozenset()
+
+    def __new__(cls, stk_realm, parent, *args, **kwargs):
+        self = super(DeclaredContext, cls).__new__(cls, stk_realm, parent)
+        for k, v in dict(*args, **kwargs).items():
+            self.__setitem__(k, v)
+        return self
+
+    def __repr__(self):
+        return "SanicContext({:s})".format(repr(self.as_dict()))
+
+    def __str__(self):
+        return "SanicContext({:s})".format(str(self.as_dict()))
+
+    def _declared_items(self):
+        for key in self._declared:
+            try:
+                yield key, object.__getattribute__(self, key)
+            except AttributeError:
+                continue
+
+    def as_dict(self):
+        """
+        :return: a new dict, with the declared keys that are set and the inner dict's keys
+        :rtype: dict
+        """
+        _dict = dict(self._declared_items())
+        _dict.update(self._inner())
+        return _dict
+
+    def __len__(self):
+        return len(self._inner()) + sum(1 for _ in self._declared_items())
+
+    def __setattr__(self, key, value):
+        if key in self._declared:
+            return object.__setattr__(self, key, value)
+        return super(DeclaredContext, self).__setattr__(key, value)
+
+    def __setitem__(self, key, value):
+        if key in self._declared:
+            return object.__setattr__(self, key, value)
+        self._changed()
+        return self._inner().__setitem__(key, value)
+
+    def __getitem__(self, item):
+        if item in self._declared:
+            try:
+                return object.__getattribute__(self, item)
+            except AttributeError:
+                raise KeyError(item)
+        return super(DeclaredContext, self).__getitem__(item)
+
+    def __delitem__(self, key):
+        if key in self._declared:
+            try:
+                return object.__delattr__(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        self._changed()
+        return self._inner().__delitem__(key)
+
+    def __contains__(self, item):
+        if item in self._declared:
+            try:
+                object.__getattribute__(self, item)
+            except AttributeError:
+                return False
+            return True
+        return self._inner().__contains__(item)
+
+    def get(self, key, default=None):
+        try:
+            return self.__getitem__(key)
+        except KeyError:
+            return default
+
+    def snapshot(self):
+        return self.__class__(self._stk_realm, self._parent_hd, self.as_dict())
+
+    def items(self):
+        return self.as_dict().items()
+
+    def keys(self):
+        return self.as_dict().keys()
+
+    def values(self):
+        return self.as_dict().values()
+
+
+def declared_context_class(name, schema):
+    """
+    Make a DeclaredContext class with a slot for each field in a schema.
+    The fields are the schema's __slots__, or else its annotated names.
+    'request' and 'id' are always declared, because the realm sets them on
+    every request context.
+    :param name: the name for the new class
+    :param schema: a class declaring the fields
+    :return: the new DeclaredContext subclass
+    :rtype: type
+    """
+    fields = getattr(schema, '__slots__', None)
+    if fields is None:
+        fields = tuple(getattr(schema, '__annotations__', {}))
+    elif isinstance(fields, str):
+        fields = (fields,)
+    fields = tuple(dict.fromkeys(('request', 'id') + tuple(fields)))
+    reserved = DeclaredContext._slot_names.union(dir(DeclaredContext))
+    for field in fields:
+        assert field.isidentifier(), "Request context field {!r} is not a valid name.".format(field)
+        assert field not in reserved, "Request context field {!r} is a reserved name.".format(field)
+    return type(name, (DeclaredContext,), {'__slots__': fields, '_declared': frozenset(fields)})
+
+
+class ContextKey(object):
+    """
+    A data descriptor for a well-known key of a KeyedContext. Reading it
+    gets the key straight from the context's own dict, without going
+    through __getattr__, and only looks in the parents if the context
+    doesn't have the key.
+    """
+
+    __slots__ = ('key', 'value_type')
+
+    def __init__(self, key, value_type=None):
+        self.key = key
+        self.value_type = value_type
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        key = self.key
+        value = instance._dict.get(key, _UNCACHED)
+        if value is not _UNCACHED:
+            return value
+        # Like HierDict.__getitem__, without raising a KeyError for each miss
+        parent = instance._parent_hd
+        while parent is not None:
+            value = parent._dict.get(key, _UNCACHED)
+            if value is not _UNCACHED:
+                return value
+            parent = parent._parent_hd
+        raise AttributeError(key)
+
+    def __set__(self, instance, value):
+        instance.__setitem__(self.key, value)
+
+    def __delete__(self, instance):
+        try:
+            instance.__delitem__(self.key)
+        except KeyError as e:
+            raise AttributeError(*e.args)
+
+
+class KeyedContext(SanicContext):
+    """
+    A SanicContext with a ContextKey descriptor for each of its well-known
+    keys. The values are still kept in the inner dict, but a value set for
+    a key with a type must be an instance of that type. Subclasses are made
+    by keyed_context_class(), one for each plugin context.
+    """
+
+    __slots__ = ()
+    # key -> type of its values, or None for any type
+    _context_keys = {}
+
+    def __new__(cls, stk_realm, parent, *args, **kwargs):
+        self = super(KeyedContext, cls).__new__(cls, stk_realm, parent, *args, **kwargs)
+        for key, value in self._inner().items():
+            self._check_type(key, value)
+        return self
+
+    def _check_type(self, key, value):
+        value_type = self._context_keys.get(key, None)
+        if value_type is not None and not isinstance(value, value_type):
+            raise TypeError(
+                "Context key {!r} takes a {}, not a {}.".format(key, value_type.__name__, type(value).__name__)
+            )
+
+    def __setitem__(self, key, value):
+        value_type = self._context_keys.get(key, None)
+        if value_type is not None and not isinstance(value, value_type):
+            self._check_type(key, value)
+        self._changed()
+        return self._inner().__setitem__(key, value)
+
+    def __reduce__(self):
+        # The class is made at runtime, so it is made again when unpickled
+        state_dict = self.__getstate__()
+        realm = state_dict.pop('_stk_realm')
+        parent_context = state_dict.pop('_parent_hd')
+        cls = self.__class__
+        return (_new_keyed_context, (cls.__name__, cls._context_keys, realm, parent_context), state_dict)
+
+
+# (name, keys and types) -> KeyedContext subclass
+_keyed_context_classes = {}
+
+
+def keyed_context_class(name, context_keys):
+    """
+    Make a KeyedContext class with a ContextKey descriptor for each key in
+    context_keys. Classes are cached, the same name and keys give the same class.
+    :param name: the name for the new class
+    :param context_keys: key -> type of its values, or None for any type
+    :type context_keys: dict
+    :return: the KeyedContext subclass
+    :rtype: type
+    """
+    cache_key = (name, tuple(context_keys.items()))
+    cls = _keyed_context_classes.get(cache_key, None)
+    if cls is not None:
+        return cls
+    reserved = KeyedContext._slot_names.union(dir(KeyedContext))
+    namespace = {'__slots__': (), '_context_keys': dict(context_keys)}
+    for key, value_type in context_keys.items():
+        assert isinstance(key, str) and key.isidentifier(), "Context key {!r} is not a valid name.".format(key)
+        assert key not in reserved, "Context key {!r} is a reserved name.".format(key)
+        assert value_type is None or isinstance(value_type, type), "Context key {!r} type must be a class.".format(key)
+        namespace[key] = ContextKey(key, value_type)
+    _keyed_context_classes[cache_key] = cls = type(name, (KeyedContext,), namespace)
+    return cls
+
+
+def _new_keyed_context(name, context_keys, stk_realm, parent):
+    return SanicContext.__new__(keyed_context_class(name, context_keys), stk_realm, parent)
+
+
+# A SharedKeyDict value for a key in its layout that it doesn't have
+_MISSING = object()
+
+
+class KeyLayout(object):
+    """
+    The keys of a family of sibling contexts, made from one template, like
+    the realm's request contexts. Every key gets an index, and each sibling
+    keeps its values in a list by that index, see SharedKeyDict. After
+    `max_keys` keys, new keys go in a dict of the sibling that sets them.
+    """
+
+    __slots__ = ('_index', '_keys', 'max_keys')
+
+    def __init__(self, keys=(), max_keys=64):
+        assert isinstance(max_keys, int) and max_keys > 0, "max_keys must be a positive integer."
+        self._index = {}
+        self._keys = []
+        self.max_keys = max_keys
+        for key in keys:
+            self.index_of(key)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def index_of(self, key):
+        """
+        :return: the index of the key, added to the layout if there's room
+        :rtype: int | None
+        """
+        index = self._index.get(key, None)
+        if index is None and len(self._keys) < self.max_keys:
+            self._index[key] = index = len(self._keys)
+            self._keys.append(key)
+        return index
+
+    def new_context(self, stk_realm, parent, items):
+        """
+        :return: a SanicContext keeping its own keys in this layout
+        :rtype: SanicContext
+        """
+        context = SanicContext(stk_realm, parent)
+        object.__setattr__(context, '_dict', SharedKeyDict(self, items))
+        return context
+
+
+class SharedKeyDict(MutableMapping):
+    """
+    A dict-like store for a HierDict, that keeps its values in a list, by
+    the index of their key in a KeyLayout shared with its siblings. It is
+    smaller than a dict with the same keys. Keys are in layout order, not
+    in the order they were set.
+    """
+
+    __slots__ = ('_layout', '_values', '_extra')
+
+    def __init__(self, layout, items=None):
+        self._layout = layout
+        self._values = [_MISSING] * len(layout._keys)
+        self._extra = None
+        if items:
+            for key, value in items.items():
+                self[key] = value
+
+    def __getitem__(self, key):
+        index = self._layout._index.get(key, None)
+        if index is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        values = self._values
+        if index < len(values):
+            value = values[index]
+            if value is not _MISSING:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        index = self._layout.index_of(key)
+        if index is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+            return
+        values = self._values
+        if index >= len(values):
+            # a sibling added keys to the layout since this was made
+            values.extend([_MISSING] * (index + 1 - len(values)))
+        values[index] = value
+
+    def __delitem__(self, key):
+        index = self._layout._index.get(key, None)
+        if index is None:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+            return
+        values = self._values
+        if index >= len(values) or values[index] is _MISSING:
+            raise KeyError(key)
+        values[index] = _MISSING
+
+    def __contains__(self, key):
+        index = self._layout._index.get(key, None)
+        if index is None:
+            return self._extra is not None and key in self._extra
+        values = self._values
+        return index < len(values) and values[index] is not _MISSING
+
+    def __iter__(self):
+        for key, value in zip(self._layout._keys, self._values):
+            if value is not _MISSING:
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        count = len(self._values) - self._values.count(_MISSING)
+        return count if self._extra is None else count + len(self._extra)
+
+    def clear(self):
+        self._values = [_MISSING] * len(self._layout._keys)
+        self._extra = None
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def __str__(self):
+        return str(dict(self))
+
+    def __reduce__(self):
+        # the _MISSING placeholders can't be pickled, so it's made again from its items
+        return (SharedKeyDict, (self._layout, dict(self)))
+
+
+class ReleasedSanicContext(SanicContext):
+    """
+    A pooled SanicContext gets this class while it sits in the pool, when
+    the pool is in debug mode, so any use of it after release fails loudly.
+    """
+
+    __slots__ = ()
+
+    def _released(self, *args, **kwargs):
+        raise RuntimeError("This request context was used after it was released to the context pool.")
+
+    __getitem__ = __setitem__ = __delitem__ = __contains__ = __len__ = _released
+    get = set = items = keys = values = update = replace = _released
+
+    def __getattr__(self, item):
+        if item in self._slot_names:
+            return object.__getattribute__(self, item)
+        self._released()
+
+    def __setattr__(self, key, value):
+        if key in self._slot_names:
+            return object.__setattr__(self, key, value)
+        self._released()
+
+
+class ContextPool(object):
+    """
+    A bounded free-list of SanicContext objects, for request contexts.
+    A released context is cleared and kept for the next acquire(), instead
+    of being freed and allocated again. At most `max_size` are kept. In
+    `debug` mode, a released context raises RuntimeError when it is used.
+    A context acquired with a KeyLayout keeps its keys in that layout.
+    """
+
+    __slots__ = ('max_size', 'debug', '_free')
+
+    def __init__(self, max_size, debug=False):
+        assert isinstance(max_size, int) and max_size > 0, "max_size must be a positive integer."
+        self.max_size = max_size
+        self.debug = debug
+        self._free = []
+
+    def __len__(self):
+        return len(self._free)
+
+    def acquire(self, stk_realm, parent, items, layout=None):
+        if not self._free:
+            if layout is not None:
+                return layout.new_context(stk_realm, parent, items)
+            return SanicContext(stk_realm, parent, items)
+        context = self._free.pop()
+        if self.debug:
+            object.__setattr__(context, '__class__', SanicContext)
+        store = object.__getattribute__(context, '_dict')
+        if layout is not None:
+            if type(store) is not SharedKeyDict or store._layout is not layout:
+                object.__setattr__(context, '_dict', SharedKeyDict(layout, items))
+            else:
+                store.update(items)
+        elif type(store) is not dict:
+            object.__setattr__(context, '_dict', dict(items))
+        else:
+            store.update(items)
+        context._attach(parent)
+        object.__setattr__(context, '_stk_realm', stk_realm)
+        return context
+
+    def release(self, context):
+        context_type = type(context)
+        if context_type is ReleasedSanicContext:
+            raise RuntimeError("This request context was already released to the context pool.")
+        if context_type is not SanicContext or len(self._free) >= self.max_size:
+            return
+        object.__getattribute__(context, '_dict').clear()
+        object.__setattr__(context, '_parent_hd', None)
+        object.__setattr__(context, '_lookup_cache', None)
+        if self.debug:
+            object.__setattr__(context, '__class__', ReleasedSanicContext)
+        self._free.append(context)
@@ -0,0 +1,458 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers used by the Sanic Plugin Toolkit Realm to build its middleware
+chains when the app server starts, and to run them.
+"""
+from asyncio import CancelledError
+from asyncio import TimeoutError as AsyncTimeoutError
+from asyncio import ensure_future, gather, get_running_loop, wait_for
+from bisect import bisect_left
+from collections import deque, namedtuple
+from inspect import isawaitable
+from time import monotonic, perf_counter
+
+from sanic.exceptions import ServiceUnavailable
+from sanic.log import logger
+
+
+PluginMiddleware = namedtuple(
+    'PluginMiddleware',
+    ['priority', 'insert_order', 'middleware', 'route_filter', 'group', 'timeout', 'on_timeout', 'plugin'],
+)
+
+# Upper bounds (in seconds) of the middleware latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, float('inf'))
+
+HTTP_METHODS = frozenset({'GET', 'POST', 'PUT', 'HEAD', 'OPTIONS', 'PATCH', 'DELETE'})
+
+
+def _all_of(*decisions):
+    # Three-valued AND, None means "can only be known per request"
+    if False in decisions:
+        return False
+    if None in decisions:
+        return None
+    return True
+
+
+class RouteRules(object):
+    """
+    A set of route rules, as given in the `include` or `exclude` argument
+    of a plugin middleware.
+    A rule starting with '/' is a URI prefix, an upper-case HTTP method name
+    is a method, anything else is a route name. A route name matches either
+    the full route name, or the end of it, eg 'MyPlugin.handler' matches
+    the route named 'my_app.MyPlugin.handler'.
+    A route matches the rules if it matches one of the given names or
+    prefixes, and one of the given methods.
+    """
+
+    __slots__ = ('names', 'name_suffixes', 'prefixes', 'prefix_dirs', 'methods')
+
+    def __init__(self, rules):
+        if isinstance(rules, str):
+            rules = (rules,)
+        names = set()
+        prefixes = set()
+        methods = set()
+        for rule in rules:
+            assert isinstance(rule, str), "Middleware route rules must be strings."
+            if rule.startswith('/'):
+                prefixes.add(rule.rstrip('/'))
+            elif rule in HTTP_METHODS:
+                methods.add(rule)
+            else:
+                names.add(rule)
+        self.names = frozenset(names)
+        self.name_suffixes = tuple('.' + n for n in names)
+        self.prefixes = frozenset(prefixes)
+        self.prefix_dirs = tuple(p + '/' for p in prefixes)
+        self.methods = frozenset(methods)
+
+    def _match_name(self, name):
+        if name is None:
+            return False
+        return name in self.names or name.endswith(self.name_suffixes)
+
+    def _match_path(self, path):
+        return path in self.prefixes or path.startswith(self.prefix_dirs)
+
+    def _match_uri(self, uri):
+        if '<' not in uri:
+            return self._match_path(uri)
+        # Only the part of the URI before the first parameter is known
+        static_part = uri.split('<', 1)[0]
+        decision = False
+        for prefix_dir in self.prefix_dirs:
+            if len(static_part) >= len(prefix_dir):
+                if static_part.startswith(prefix_dir):
+                    return True
+            elif prefix_dir.startswith(static_part):
+                decision = None
+        return decision
+
+    def match_route(self, route):
+        """
+        :param route: a route from the app router
+        :type route: sanic_routing.Route
+        :return: True or False if the rules are decided by the route alone,
+                 or None if they need to be checked on each request
+        :rtype: bool | None
+        """
+        if self.names or self.prefixes:
+            if self._match_name(route.name):
+                route_match = True
+            elif self.prefixes:
+                route_match = self._match_uri(route.uri)
+            else:
+                route_match = False
+        else:
+            route_match = True
+        if not self.methods:
+            method_match = True
+        elif route.methods <= self.methods:
+            method_match = True
+        elif route.methods.isdisjoint(self.methods):
+            method_match = False
+        else:
+            method_match = None
+        return _all_of(route_match, method_match)
+
+    def match_request(self, request):
+        if self.names or self.prefixes:
+            if not (self._match_name(request.name) or (self.prefixes and self._match_path(request.path))):
+                return False
+        if self.methods and request.method not in self.methods:
+            return False
+        return True
+
+
+class RouteFilter(object):
+    """
+    The resolved `include` and `exclude` rules of a plugin middleware.
+    """
+
+    __slots__ = ('include', 'exclude')
+
+    def __init__(self, include=None, exclude=None):
+        self.include = RouteRules(include) if include else None
+        self.exclude = RouteRules(exclude) if exclude else None
+
+    def _decide_route(self, route):
+        included = True if self.include is None else self.include.match_route(route)
+        if self.exclude is None:
+            not_excluded = True
+        else:
+            excluded = self.exclude.match_route(route)
+            not_excluded = None if excluded is None else not excluded
+        return _all_of(included, not_excluded)
+
+    def decide(self, routes):
+        """
+        Decide at startup whether the middleware runs on the named route.
+        :param routes: all of the routes sharing one route name, or None
+                       for requests that are not matched to a named route.
+        :type routes: list | None
+        :return: True to always run, False to never run, or None to check
+                 each request with allows()
+        :rtype: bool | None
+        """
+        if not routes:
+            return None
+        decisions = {self._decide_route(route) for route in routes}
+        if len(decisions) == 1:
+            return decisions.pop()
+        return None
+
+    def allows(self, request):
+        if self.include is not None and not self.include.match_request(request):
+            return False
+        if self.exclude is not None and self.exclude.match_request(request):
+            return False
+        return True
+
+    def guard(self, middleware, awaits):
+        """
+        Wrap a classified middleware so it only runs when allows() says so.
+        :return: the new (middleware, awaits) pair
+        :rtype: tuple
+        """
+        allows = self.allows
+
+        def guarded_middleware(request, *args):
+            if allows(request):
+                return middleware(request, *args)
+            return None
+
+        # A skipped coroutine middleware returns None, so check each call
+        return guarded_middleware, None
+
+
+async def _run_group_member(middleware, awaits, request):
+    response = middleware(request)
+    if awaits or isawaitable(response):
+        response = await response
+    return response
+
+
+def concurrent_group(members):
+    """
+    Join request middleware from the same concurrent group into one entry
+    for the chain, that runs them all together under asyncio.gather.
+    Every member is run to completion. If any of them raised an exception,
+    the first one to have raised (in chain order) is re-raised. Otherwise
+    the first response (in chain order) is returned, and that stops the
+    rest of the chain, like a response from a sequential middleware.
+    :param members: the (middleware, awaits) pairs in the group
+    :type members: list
+    :return: a (middleware, awaits) pair
+    :rtype: tuple
+    """
+    if len(members) == 1:
+        return members[0]
+    members = tuple(members)
+
+    async def run_concurrent_group(request):
+        results = await gather(*[_run_group_member(m, a, request) for (m, a) in members], return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        for result in results:
+            if result:
+                return result
+        return None
+
+    return run_concurrent_group, True
+
+
+TIMEOUT_POLICIES = ('skip', '503', 'raise')
+
+
+def _timed_out(on_timeout, error, name):
+    if on_timeout == 'skip':
+        logger.warning("SPTK middleware {} timed out, and was skipped.".format(name))
+        return None
+    if on_timeout == '503':
+        raise ServiceUnavailable("Middleware {} timed out.".format(name))
+    raise error
+
+
+def time_limited(middleware, awaits, timeout, on_timeout):
+    """
+    Wrap a classified middleware so it is cancelled when it runs for longer
+    than `timeout` seconds, and the `on_timeout` policy is applied instead:
+    'skip' carries on as if it returned None, '503' raises ServiceUnavailable,
+    and 'raise' lets the asyncio.TimeoutError through.
+    A sync middleware can't be interrupted, the limit only applies to the
+    awaitable it gives back, if any.
+    :return: the new (middleware, awaits) pair
+    :rtype: tuple
+    """
+    name = getattr(middleware, '__name__', repr(middleware))
+
+    async def run_time_limited(request, *args):
+        result = middleware(request, *args)
+        if awaits or isawaitable(result):
+            try:
+                result = await wait_for(result, timeout)
+            except AsyncTimeoutError as e:
+                return _timed_out(on_timeout, e, name)
+        return result
+
+    return run_time_limited, True
+
+
+def budget_limited(middleware, awaits, get_request_context, on_timeout):
+    """
+    Wrap a chain entry so it draws on the request's total middleware budget.
+    The seconds left are kept in the shared request context under the key
+    'middleware_budget'. The entry is cancelled when it runs past them, and
+    once they are used up it isn't run at all, see time_limited() for the
+    `on_timeout` policies. Requests without a budget run the entry as is.
+    :return: the new (middleware, awaits) pair
+    :rtype: tuple
+    """
+    name = getattr(middleware, '__name__', repr(middleware))
+
+    async def run_budget_limited(request, *args):
+        shared_req_context = get_request_context(request)
+        remaining = shared_req_context.get('middleware_budget', None) if shared_req_context is not None else None
+        if remaining is None:
+            result = middleware(request, *args)
+            if awaits or isawaitable(result):
+                result = await result
+            return result
+        if remaining <= 0:
+            return _timed_out(on_timeout, AsyncTimeoutError(), name)
+        start = monotonic()
+        try:
+            result = middleware(request, *args)
+            if awaits or isawaitable(result):
+                result = await wait_for(result, remaining)
+        except AsyncTimeoutError as e:
+            return _timed_out(on_timeout, e, name)
+        finally:
+            shared_req_context['middleware_budget'] = remaining - (monotonic() - start)
+        return result
+
+    return run_budget_limited, True
+
+
+class MiddlewareStats(object):
+    """
+    Counters for one plugin middleware in one phase: how many times it ran,
+    how many of those raised an exception, and a histogram of how long it
+    took, with one count for each of the LATENCY_BUCKETS.
+    """
+
+    __slots__ = ('plugin_name', 'phase', 'name', 'count', 'errors', 'total_time', 'buckets')
+
+    def __init__(self, plugin_name, phase, name):
+        self.plugin_name = plugin_name
+        self.phase = phase
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+
+    def record(self, elapsed, failed=False):
+        self.count += 1
+        if failed:
+            self.errors += 1
+        self.total_time += elapsed
+        self.buckets[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+    def to_dict(self):
+        return {
+            'plugin': self.plugin_name,
+            'phase': self.phase,
+            'middleware': self.name,
+            'count': self.count,
+            'errors': self.errors,
+            'total_time': self.total_time,
+            'histogram': list(zip(LATENCY_BUCKETS, self.buckets)),
+        }
+
+
+def instrumented(middleware, awaits, stats):
+    """
+    Wrap a classified middleware so each run of it is recorded in `stats`.
+    :return: the new (middleware, awaits) pair
+    :rtype: tuple
+    """
+    record = stats.record
+
+    async def run_instrumented(request, *args):
+        start = perf_counter()
+        try:
+            result = middleware(request, *args)
+            if awaits or isawaitable(result):
+                result = await result
+        except Exception:
+            record(perf_counter() - start, True)
+            raise
+        record(perf_counter() - start)
+        return result
+
+    return run_instrumented, True
+
+
+OVERFLOW_POLICIES = ('inline', 'drop', 'block')
+
+
+class BackgroundRunner(object):
+    """
+    Runs coroutines as background tasks, off the request's latency path.
+    At most `max_tasks` of them are in flight at once, and up to
+    `max_queued` more wait in a queue for a free slot. When both are full,
+    the `overflow` policy decides what happens to a new coroutine:
+    'inline' awaits it in the caller, 'drop' closes it without running it,
+    and 'block' makes the caller wait until there is room for it.
+    """
+
+    __slots__ = ('max_tasks', 'max_queued', 'overflow', '_tasks', '_queue', '_waiters')
+
+    def __init__(self, max_tasks, max_queued=0, overflow='inline'):
+        assert isinstance(max_tasks, int) and max_tasks > 0, "max_tasks must be a positive integer."
+        assert isinstance(max_queued, int) and max_queued >= 0, "max_queued must be zero or a positive integer."
+        assert overflow in OVERFLOW_POLICIES, "overflow must be one of {}.".format(", ".join(OVERFLOW_POLICIES))
+        self.max_tasks = max_tasks
+        self.max_queued = max_queued
+        self.overflow = overflow
+        self._tasks = set()
+        self._queue = deque()
+        self._waiters = deque()
+
+    def __len__(self):
+        return len(self._tasks) + len(self._queue)
+
+    def _start(self, coro):
+        task = ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._task_done)
+
+    def _task_done(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("SPTK background task failed: {}".format(repr(task.exception())))
+        if self._queue and len(self._tasks) < self.max_tasks:
+            self._start(self._queue.popleft())
+        # There is room again, wake the next blocked caller
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    async def submit(self, coro):
+        """
+        Hand a coroutine to the runner.
+        :return: False if the coroutine was dropped, otherwise True
+        :rtype: bool
+        """
+        while True:
+            if len(self._tasks) < self.max_tasks:
+                self._start(coro)
+                return True
+            if len(self._queue) < self.max_queued:
+                self._queue.append(coro)
+                return True
+            if self.overflow == 'drop':
+                coro.close()
+                logger.warning("SPTK background runner is full, a task was dropped.")
+                return False
+            if self.overflow == 'inline':
+                _ = await coro  # noqa: F841
+                return True
+            waiter = get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                _ = await waiter  # noqa: F841
+            except CancelledError:
+                # The caller gave up waiting, but the work was handed over to
+                # us already. It must still run, even if it is over the limit.
+                self._start(coro)
+                raise
+
+    async def drain(self):
+        """Wait for all of the in-flight and queued tasks to finish."""
+        while self._tasks:
+            _ = await gather(*self._tasks, return_exceptions=True)  # noqa: F841
+
+
+async def run_after_response_chain(chain, request, response):
+    """
+    Run every after_response middleware in the chain, in order. They are
+    only run for their side effects, so their return values are ignored,
+    and an exception in one of them is logged and doesn't stop the rest.
+    """
+    for (middleware, awaits) in chain:
+        try:
+            result = middleware(request, response)
+            if awaits or isawaitable(result):
+                _ = await result  # noqa: F841
+        except CancelledError:
+            raise
+        except Exception:
+            logger.exception("Exception occurred in one of the after_response middleware handlers")
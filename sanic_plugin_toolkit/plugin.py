@@ -5,7 +5,7 @@ from collections import defaultdict, deque, namedtuple
 from distutils.version import LooseVersion
 from functools import update_wrapper
 from inspect import isawaitable
-from typing import Type
+from typing import Dict, Optional, Type
 
 from sanic import Blueprint, Sanic
 from sanic import __version__ as sanic_version
@@ -44,6 +44,12 @@ class SanicPlugin(object):
     )
 
     AssociatedTuple: Type[object] = PluginAssociated
+    # A class whose __slots__ (or annotations) declare the fields of this
+    # plugin's private request contexts, which are then kept in slots.
+    RequestContext: Optional[Type[object]] = None
+    # The well-known keys of this plugin's context, each with the type of its
+    # values (or None). They are read and set through descriptors on the context.
+    context_keys: Optional[Dict[str, Optional[Type[object]]]] = None
 
     # Decorator
     def middleware(self, *args, **kwargs):
@@ -59,6 +65,11 @@ class SanicPlugin(object):
         kwargs.setdefault('relative', None)
         kwargs.setdefault('attach_to', None)
         kwargs.setdefault('with_context', False)
+        kwargs.setdefault('include', None)
+        kwargs.setdefault('exclude', None)
+        kwargs.setdefault('concurrent', False)
+        kwargs.setdefault('timeout', None)
+        kwargs.setdefault('on_timeout', 'raise')
         if len(args) == 1 and callable(args[0]):
             middle_f = args[0]
             self._middlewares.append(FutureMiddleware(middle_f, args=tuple(), kwargs=kwargs))
@@ -283,7 +294,11 @@ class SanicPlugin(object):
         :type app: Sanic | Blueprint
         :param args:
         :type args: tuple(Any)
-        :param run_middleware:
+        :param run_middleware: run the plugin's request, response and cleanup
+                               middleware around the route, if the plugin
+                               isn't registered on the app. after_response
+                               middleware can't be run this way, the route
+                               can't see its response being sent.
         :type run_middleware: bool
         :param with_context:
         :type with_context: bool
@@ -312,71 +327,103 @@ class SanicPlugin(object):
             run_middleware = False
         req_middleware = deque()
         resp_middleware = deque()
+        cleanup_middleware = deque()
         if run_middleware:
             for i, m in enumerate(plugin._middlewares):
-                attach_to = m.kwargs.pop('attach_to', 'request')
-                priority = m.kwargs.pop('priority', 5)
-                with_context = m.kwargs.pop('with_context', False)
+                # popping from a copy, so the plugin can still decorate other routes
+                mw_kwargs = dict(m.kwargs)
+                attach_to = mw_kwargs.pop('attach_to', 'request')
+                priority = mw_kwargs.pop('priority', 5)
+                with_context = mw_kwargs.pop('with_context', False)
+                # route rules don't apply, this middleware only runs on the decorated route
+                _ = mw_kwargs.pop('include', None)
+                _ = mw_kwargs.pop('exclude', None)
+                _ = mw_kwargs.pop('concurrent', False)
+                # neither do timeouts, they are enforced by the realm's middleware runner
+                _ = mw_kwargs.pop('timeout', None)
+                _ = mw_kwargs.pop('on_timeout', None)
                 mw_handle_fn = m.middleware
-                if attach_to == 'response':
-                    relative = m.kwargs.pop('relative', 'post')
+                assert attach_to != 'after_response', (
+                    "An after_response middleware can't be run on a decorated route, "
+                    "register the plugin on the app instead."
+                )
+                if attach_to == 'cleanup':
+                    _ = mw_kwargs.pop('relative', None)
+                    cleanup_middleware.append((priority, i, mw_handle_fn, with_context, m.args, mw_kwargs))
+                elif attach_to == 'response':
+                    relative = mw_kwargs.pop('relative', 'post')
                     if relative == "pre":
-                        mw = (0, 0 - priority, 0 - i, mw_handle_fn, with_context, m.args, m.kwargs)
+                        mw = (0, 0 - priority, 0 - i, mw_handle_fn, with_context, m.args, mw_kwargs)
                     else:  # relative = "post"
-                        mw = (1, 0 - priority, 0 - i, mw_handle_fn, with_context, m.args, m.kwargs)
+                        mw = (1, 0 - priority, 0 - i, mw_handle_fn, with_context, m.args, mw_kwargs)
                     resp_middleware.append(mw)
                 else:  # attach_to = "request"
-                    relative = m.kwargs.pop('relative', 'pre')
+                    relative = mw_kwargs.pop('relative', 'pre')
                     if relative == "post":
-                        mw = (1, priority, i, mw_handle_fn, with_context, m.args, m.kwargs)
+                        mw = (1, priority, i, mw_handle_fn, with_context, m.args, mw_kwargs)
                     else:  # relative = "pre"
-                        mw = (0, priority, i, mw_handle_fn, with_context, m.args, m.kwargs)
+                        mw = (0, priority, i, mw_handle_fn, with_context, m.args, mw_kwargs)
                     req_middleware.append(mw)
 
         req_middleware = tuple(sorted(req_middleware))
         resp_middleware = tuple(sorted(resp_middleware))
+        cleanup_middleware = tuple(sorted(cleanup_middleware))
 
         def _decorator(f):
             nonlocal realm, plugin, regd, run_middleware, with_context
-            nonlocal req_middleware, resp_middleware, args, kwargs
+            nonlocal req_middleware, resp_middleware, cleanup_middleware, args, kwargs
 
             async def wrapper(request, *a, **kw):
                 nonlocal realm, plugin, regd, run_middleware, with_context
-                nonlocal req_middleware, resp_middleware, f, args, kwargs
+                nonlocal req_middleware, resp_middleware, cleanup_middleware, f, args, kwargs
                 # the plugin was not registered on the app, it might be now
                 if regd is None:
                     _inst = realm.get_plugin_inst(plugin)
                     regd = _inst is not None
 
                 context = plugin.get_context_from_realm(realm)
-                if run_middleware and not regd and len(req_middleware) > 0:
-                    for (_a, _p, _i, handler, with_context, args, kwargs) in req_middleware:
-                        if with_context:
-                            resp = handler(request, *args, context=context, **kwargs)
-                        else:
-                            resp = handler(request, *args, **kwargs)
-                        if isawaitable(resp):
-                            resp = await resp
-                        if resp:
-                            return
-
-                response = await plugin.route_wrapper(
-                    f, request, context, a, kw, *args, with_context=with_context, **kwargs
-                )
-                if isawaitable(response):
-                    response = await response
-                if run_middleware and not regd and len(resp_middleware) > 0:
-                    for (_a, _p, _i, handler, with_context, args, kwargs) in resp_middleware:
-                        if with_context:
-                            _resp = handler(request, response, *args, context=context, **kwargs)
-                        else:
-                            _resp = handler(request, response, *args, **kwargs)
-                        if isawaitable(_resp):
-                            _resp = await _resp
-                        if _resp:
-                            response = _resp
-                            break
-                return response
+                run_here = run_middleware and not regd
+                try:
+                    if run_here and len(req_middleware) > 0:
+                        for (_a, _p, _i, handler, mw_with_context, mw_args, mw_kwargs) in req_middleware:
+                            if mw_with_context:
+                                resp = handler(request, *mw_args, context=context, **mw_kwargs)
+                            else:
+                                resp = handler(request, *mw_args, **mw_kwargs)
+                            if isawaitable(resp):
+                                resp = await resp
+                            if resp:
+                                return
+
+                    response = await plugin.route_wrapper(
+                        f, request, context, a, kw, *args, with_context=with_context, **kwargs
+                    )
+                    if isawaitable(response):
+                        response = await response
+                    if run_here and len(resp_middleware) > 0:
+                        for (_a, _p, _i, handler, mw_with_context, mw_args, mw_kwargs) in resp_middleware:
+                            if mw_with_context:
+                                _resp = handler(request, response, *mw_args, context=context, **mw_kwargs)
+                            else:
+                                _resp = handler(request, response, *mw_args, **mw_kwargs)
+                            if isawaitable(_resp):
+                                _resp = await _resp
+                            if _resp:
+                                response = _resp
+                                break
+                    return response
+                finally:
+                    # like the realm's cleanup middleware, run even when there is no response
+                    if run_here and len(cleanup_middleware) > 0:
+                        for (_p, _i, handler, mw_with_context, mw_args, mw_kwargs) in cleanup_middleware:
+                            if mw_with_context:
+                                _resp = handler(request, *mw_args, context=context, **mw_kwargs)
+                            else:
+                                _resp = handler(request, *mw_args, **mw_kwargs)
+                            if isawaitable(_resp):
+                                _resp = await _resp
+                            if _resp:
+                                break
 
             return update_wrapper(wrapper, f)
 
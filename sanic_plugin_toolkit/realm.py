@@ -3,13 +3,16 @@ import importlib
 import re
 import sys
 
-from asyncio import CancelledError
+from asyncio import CancelledError, sleep
 from collections import deque
+from contextvars import ContextVar
 from distutils.version import LooseVersion
 from functools import partial, update_wrapper
-from inspect import isawaitable, ismodule
+from inspect import isawaitable, iscoroutinefunction, ismodule
+from time import monotonic
 from typing import Any, Dict
 from uuid import uuid1
+from weakref import WeakValueDictionary
 
 from sanic import Blueprint, Sanic
 from sanic import __version__ as sanic_version
@@ -28,8 +31,32 @@ except ImportError:
     from sanic.response import HTTPResponse as BaseHTTPResponse
 
 from sanic_plugin_toolkit.config import load_config_file
-from sanic_plugin_toolkit.context import SanicContext
+from sanic_plugin_toolkit.context import (
+    ContextPool,
+    KeyLayout,
+    PluginRequestContexts,
+    RequestContextAnchor,
+    RequestContextBinding,
+    RequestContextRegistry,
+    SanicContext,
+    SharedRequestContexts,
+    declared_context_class,
+    keyed_context_class,
+)
+from sanic_plugin_toolkit.middleware import (
+    TIMEOUT_POLICIES,
+    BackgroundRunner,
+    MiddlewareStats,
+    PluginMiddleware,
+    RouteFilter,
+    budget_limited,
+    concurrent_group,
+    instrumented,
+    run_after_response_chain,
+    time_limited,
+)
 from sanic_plugin_toolkit.plugin import PluginRegistration, SanicPlugin
+from sanic_plugin_toolkit.shared_buffers import SharedBuffers
 
 
 module = sys.modules[__name__]
@@ -37,6 +64,23 @@ CONSTS: Dict[str, Any] = dict()
 CONSTS["APP_CONFIG_INSTANCE_KEY"] = APP_CONFIG_INSTANCE_KEY = "__SPTK_INSTANCE"
 CONSTS["SPTK_LOAD_INI_KEY"] = SPTK_LOAD_INI_KEY = "SPTK_LOAD_INI"
 CONSTS["SPTK_INI_FILE_KEY"] = SPTK_INI_FILE_KEY = "SPTK_INI_FILE"
+CONSTS["SPTK_AFTER_RESPONSE_MAX_TASKS_KEY"] = SPTK_AFTER_RESPONSE_MAX_TASKS_KEY = "SPTK_AFTER_RESPONSE_MAX_TASKS"
+CONSTS["SPTK_CLEANUP_MAX_TASKS_KEY"] = SPTK_CLEANUP_MAX_TASKS_KEY = "SPTK_CLEANUP_MAX_TASKS"
+CONSTS["SPTK_CLEANUP_QUEUE_SIZE_KEY"] = SPTK_CLEANUP_QUEUE_SIZE_KEY = "SPTK_CLEANUP_QUEUE_SIZE"
+CONSTS["SPTK_CLEANUP_OVERFLOW_KEY"] = SPTK_CLEANUP_OVERFLOW_KEY = "SPTK_CLEANUP_OVERFLOW"
+CONSTS["SPTK_MIDDLEWARE_BUDGET_KEY"] = SPTK_MIDDLEWARE_BUDGET_KEY = "SPTK_MIDDLEWARE_BUDGET"
+CONSTS["SPTK_REQUEST_CONTEXTVARS_KEY"] = SPTK_REQUEST_CONTEXTVARS_KEY = "SPTK_REQUEST_CONTEXTVARS"
+CONSTS["SPTK_REQUEST_CONTEXT_POOL_SIZE_KEY"] = SPTK_REQUEST_CONTEXT_POOL_SIZE_KEY = "SPTK_REQUEST_CONTEXT_POOL_SIZE"
+CONSTS["SPTK_REQUEST_CONTEXT_POOL_DEBUG_KEY"] = SPTK_REQUEST_CONTEXT_POOL_DEBUG_KEY = "SPTK_REQUEST_CONTEXT_POOL_DEBUG"
+CONSTS[
+    "SPTK_REQUEST_CONTEXT_SWEEP_INTERVAL_KEY"
+] = SPTK_REQUEST_CONTEXT_SWEEP_INTERVAL_KEY = "SPTK_REQUEST_CONTEXT_SWEEP_INTERVAL"
+CONSTS["SPTK_REQUEST_CONTEXT_MAX_AGE_KEY"] = SPTK_REQUEST_CONTEXT_MAX_AGE_KEY = "SPTK_REQUEST_CONTEXT_MAX_AGE"
+CONSTS[
+    "SPTK_REQUEST_CONTEXT_SHARED_KEYS_KEY"
+] = SPTK_REQUEST_CONTEXT_SHARED_KEYS_KEY = "SPTK_REQUEST_CONTEXT_SHARED_KEYS"
+CONSTS["SPTK_MIDDLEWARE_STATS_KEY"] = SPTK_MIDDLEWARE_STATS_KEY = "SPTK_MIDDLEWARE_STATS"
+CONSTS["SPTK_BUDGET_ON_TIMEOUT_KEY"] = SPTK_BUDGET_ON_TIMEOUT_KEY = "SPTK_MIDDLEWARE_BUDGET_ON_TIMEOUT"
 CONSTS["SANIC_19_12_0"] = SANIC_19_12_0 = LooseVersion("19.12.0")
 CONSTS["SANIC_20_12_1"] = SANIC_20_12_1 = LooseVersion("20.12.1")
 CONSTS["SANIC_21_3_0"] = SANIC_21_3_0 = LooseVersion("21.3.0")
@@ -54,6 +98,13 @@ WARNING = 30
 INFO = 20
 DEBUG = 10
 
+MIDDLEWARE_PHASES = ('pre_request', 'post_request', 'pre_response', 'post_response', 'cleanup', 'after_response')
+
+# The keys the realm sets on the shared context and on every plugin's context,
+# read through descriptors, see keyed_context_class()
+SHARED_CONTEXT_KEYS = {'app': None, 'request': None, 'buffers': SharedBuffers}
+PLUGIN_CONTEXT_KEYS = {'shared': SanicContext, 'request': None, 'log': None, 'url_for': None}
+
 to_snake_case_first_cap_re = re.compile('(.)([A-Z][a-z]+)')
 to_snake_case_all_cap_re = re.compile('([a-z0-9])([A-Z])')
 
@@ -71,17 +122,57 @@ def to_snake_case(name):
     return to_snake_case_all_cap_re.sub(r'\1_\2', s1).lower()
 
 
+def classify_middleware(middleware):
+    """
+    Helper function, used when the middleware chains are frozen.
+    Works out once whether calling the middleware gives back something
+    that needs to be awaited, so the runners don't need to ask every time.
+    :param middleware: the middleware callable
+    :type middleware: callable
+    :return: a (middleware, awaits) pair. awaits is True for coroutine
+             functions, and None for everything else, when it can only be
+             known by checking the result of each call. A sync function can
+             still give back an awaitable, like a lambda that calls a
+             coroutine function.
+    :rtype: tuple
+    """
+    func = middleware
+    # with_context middleware is a partial, look through it
+    while isinstance(func, partial):
+        func = func.func
+    if iscoroutinefunction(func):
+        return middleware, True
+    return middleware, None
+
+
 class SanicPluginRealm(object):
     __slots__ = (
         '_running',
         '_app',
         '_plugin_names',
         '_contexts',
+        '_live_request_contexts',
+        '_live_request_count',
+        '_requests_in_flight',
+        '_request_context_var',
+        '_request_context_pool',
+        '_request_context_layouts',
+        '_request_context_sweeper',
+        '_shared_buffers',
+        '_serving_buffer_names',
         '_pre_request_middleware',
         '_post_request_middleware',
         '_pre_response_middleware',
         '_post_response_middleware',
         '_cleanup_middleware',
+        '_after_response_middleware',
+        '_after_response_runner',
+        '_cleanup_runner',
+        '_middleware_budget',
+        '_middleware_stats',
+        '_plugin_middleware_chains',
+        '_request_middleware_chains',
+        '_response_middleware_chains',
         '_loop',
         '__weakref__',
     )
@@ -210,7 +301,18 @@ class SanicPluginRealm(object):
             )
         self._plugin_names.add(name)
         shared_context = self.shared_context
-        self._contexts[name] = context = SanicContext(self, shared_context, {'shared': shared_context})
+        context_keys = dict(PLUGIN_CONTEXT_KEYS)
+        for key, value_type in (plugin.context_keys or {}).items():
+            assert key not in PLUGIN_CONTEXT_KEYS, "Context key {!r} is set by the realm.".format(key)
+            context_keys[key] = value_type
+        context_class = keyed_context_class(name + 'Context', context_keys)
+        self._contexts[name] = context = context_class(self, shared_context, {'shared': shared_context})
+        # The private request contexts in here are only created when they are used
+        schema = plugin.RequestContext
+        context_class = declared_context_class(name + 'RequestContext', schema) if schema is not None else None
+        context['request'] = PluginRequestContexts(
+            self, None, {'id': 'private request contexts'}, plugin_name=name, context_class=context_class
+        )
         _p_context = self._plugins_context
         _plugin_reg = _p_context.get(name, None)
         if _plugin_reg is None:
@@ -408,6 +510,11 @@ class SanicPluginRealm(object):
         relative=None,
         attach_to=None,
         with_context=False,
+        include=None,
+        exclude=None,
+        concurrent=False,
+        timeout=None,
+        on_timeout='raise',
         **kwargs,
     ):
         assert isinstance(priority, int), "Priority must be an integer!"
@@ -421,9 +528,16 @@ class SanicPluginRealm(object):
             attach_to = args[0]
         if with_context:
             middleware = update_wrapper(partial(middleware, context=context), middleware)
+        route_filter = RouteFilter(include, exclude) if (include or exclude) else None
+        assert timeout is None or timeout > 0, "A middleware timeout must be a positive number of seconds."
+        assert on_timeout in TIMEOUT_POLICIES, "on_timeout must be one of {}.".format(", ".join(TIMEOUT_POLICIES))
+        # concurrent can be True, or the name of a group to gather with
+        group = concurrent if concurrent else None
         if attach_to is None or attach_to == "request":
             insert_order = len(self._pre_request_middleware) + len(self._post_request_middleware)
-            priority_middleware = (priority, insert_order, middleware)
+            priority_middleware = PluginMiddleware(
+                priority, insert_order, middleware, route_filter, group, timeout, on_timeout, plugin
+            )
             if relative is None or relative == 'pre':
                 # plugin request middleware default to pre-app middleware
                 self._pre_request_middleware.append(priority_middleware)
@@ -432,14 +546,31 @@ class SanicPluginRealm(object):
                 self._post_request_middleware.append(priority_middleware)
         elif attach_to == "cleanup":
             insert_order = len(self._cleanup_middleware)
-            priority_middleware = (priority, insert_order, middleware)
+            assert group is None, "Only request middleware can be run concurrently"
+            assert on_timeout != "503", "Only request middleware can time out with a 503 response"
+            priority_middleware = PluginMiddleware(
+                priority, insert_order, middleware, route_filter, group, timeout, on_timeout, plugin
+            )
             assert relative is None, "A cleanup middleware cannot have relative pre or post"
             self._cleanup_middleware.append(priority_middleware)
+        elif attach_to == "after_response":
+            assert group is None, "Only request middleware can be run concurrently"
+            assert on_timeout != "503", "Only request middleware can time out with a 503 response"
+            insert_order = len(self._after_response_middleware)
+            priority_middleware = PluginMiddleware(
+                priority, insert_order, middleware, route_filter, group, timeout, on_timeout, plugin
+            )
+            assert relative is None, "An after_response middleware cannot have relative pre or post"
+            self._after_response_middleware.append(priority_middleware)
         else:  # response
-            assert attach_to == "response", "A middleware kind must be either request or response."
+            assert attach_to == "response", "A middleware kind must be request, response, cleanup or after_response."
             insert_order = len(self._post_response_middleware) + len(self._pre_response_middleware)
             # so they are sorted backwards
-            priority_middleware = (0 - priority, 0.0 - insert_order, middleware)
+            assert group is None, "Only request middleware can be run concurrently"
+            assert on_timeout != "503", "Only request middleware can time out with a 503 response"
+            priority_middleware = PluginMiddleware(
+                0 - priority, 0.0 - insert_order, middleware, route_filter, group, timeout, on_timeout, plugin
+            )
             if relative is None or relative == 'post':
                 # plugin response middleware default to post-app middleware
                 self._post_response_middleware.append(priority_middleware)
@@ -471,6 +602,20 @@ class SanicPluginRealm(object):
             return None
         return _context
 
+    def freeze_contexts(self, overlay=False):
+        """
+        Make a flat, read-only view of the shared context and of every plugin
+        context, for plugins that only read their context while serving.
+        See SanicContext.freeze()
+        :param overlay: give each view a dict of its own, for keys set on it
+        :return: a dict of views, by plugin name, and 'shared'
+        :rtype: dict
+        """
+        views = {'shared': self.shared_context.freeze(overlay)}
+        for name in self._plugin_names:
+            views[name] = self._contexts[name].freeze(overlay)
+        return views
+
     def get_from_context(self, item, context=None):
         context = context or 'shared'
         try:
@@ -481,58 +626,267 @@ class SanicPluginRealm(object):
         return _context.__getitem__(item)
 
     def create_temporary_request_context(self, request):
+        if self._request_context_var is not None:
+            return self._bind_request_context(request)
         request_hash = id(request)
-        shared_context = self.shared_context
-        shared_requests_dict = shared_context.get('request', False)
-        if not shared_requests_dict:
-            new_ctx = SanicContext(self, None, {'id': 'shared request contexts'})
-            shared_context['request'] = shared_requests_dict = new_ctx
-        shared_request_ctx = shared_requests_dict.get(request_hash, None)
-        if shared_request_ctx:
+        # This is the dict behind shared_context.request, see _on_server_start
+        live_request_contexts = self._live_request_contexts
+        shared_request_ctx = live_request_contexts.get(request_hash, None)
+        if shared_request_ctx is not None:
             # Somehow, we've already created a temporary context for this request.
             return shared_request_ctx
-        shared_requests_dict[request_hash] = shared_request_ctx = SanicContext(
-            self, None, {'request': request, 'id': "shared request context for request {}".format(id(request))}
-        )
-        for name, _p in self._plugins_context.items():
-            if not (isinstance(_p, SanicContext) and 'instance' in _p and isinstance(_p['instance'], SanicPlugin)):
-                continue
-            if not ('context' in _p and isinstance(_p['context'], SanicContext)):
-                continue
-            _p_context = _p['context']
-            if 'request' not in _p_context:
-                _p_context['request'] = p_request = SanicContext(self, None, {'id': 'private request contexts'})
-            else:
-                p_request = _p_context.request
-            p_request[request_hash] = SanicContext(
-                self,
-                None,
-                {'request': request, 'id': "private request context for {} on request {}".format(name, id(request))},
-            )
+        live_request_contexts[request_hash] = shared_request_ctx = self._new_shared_request_context(request)
+        self._anchor_request_context(request, shared_request_ctx)
         return shared_request_ctx
 
+    def _anchor_request_context(self, request, shared_request_ctx):
+        """
+        The realm only holds request contexts weakly. This makes the request
+        hold them, from request.ctx, so they live exactly as long as it does.
+        """
+        anchors = getattr(request.ctx, '_sptk_request_contexts', None)
+        if anchors is None:
+            anchors = request.ctx._sptk_request_contexts = {}
+        anchors[id(self)] = anchor = RequestContextAnchor(monotonic(), shared_request_ctx)
+        return anchor
+
+    def _pop_request_anchor(self, request):
+        anchors = getattr(request.ctx, '_sptk_request_contexts', None)
+        return anchors.pop(id(self), None) if anchors else None
+
+    def _new_shared_request_context(self, request):
+        items = {'request': request, 'id': "shared request context for request {}".format(id(request))}
+        layout = None if self._request_context_layouts is None else self._request_context_layouts[None]
+        if self._request_context_pool is not None:
+            shared_request_ctx = self._request_context_pool.acquire(self, None, items, layout)
+        elif layout is not None:
+            shared_request_ctx = layout.new_context(self, None, items)
+        else:
+            shared_request_ctx = SanicContext(self, None, items)
+        if self._middleware_budget is not None:
+            # seconds of plugin request middleware time left for this request
+            shared_request_ctx['middleware_budget'] = self._middleware_budget
+        return shared_request_ctx
+
+    def _bind_request_context(self, request):
+        """
+        In contextvars mode, bind the request contexts to the running request
+        task. Tasks started from it (like background middleware) see them too.
+        """
+        binding = self._request_context_var.get()
+        if binding is not None and binding.request is request:
+            # Somehow, we've already created a temporary context for this request.
+            return binding.shared
+        shared_request_ctx = self._new_shared_request_context(request)
+        self._request_context_var.set(RequestContextBinding(request, shared_request_ctx, {}))
+        self._live_request_count += 1
+        self._anchor_request_context(request, shared_request_ctx)
+        return shared_request_ctx
+
+    def _has_request_context(self, request_hash):
+        if self._request_context_var is not None:
+            binding = self._request_context_var.get()
+            return binding is not None and id(binding.request) == request_hash
+        return request_hash in self._live_request_contexts
+
+    def _create_private_request_context(self, p_request, request_hash):
+        """
+        Create a plugin's private context for a request, the first time the
+        plugin looks it up. See PluginRequestContexts.
+        :return: the new private request context, or None if the realm isn't
+                 handling a request with that id.
+        :rtype: SanicContext | None
+        """
+        name = p_request._plugin_name
+        if self._request_context_var is not None:
+            binding = self._request_context_var.get()
+            if binding is None or id(binding.request) != request_hash:
+                return None
+            private_request_ctx = binding.private.get(name, None)
+            if private_request_ctx is None:
+                binding.private[name] = private_request_ctx = self._new_private_request_context(
+                    binding.request, name, p_request._context_class
+                )
+            return private_request_ctx
+        shared_request_ctx = self._live_request_contexts.get(request_hash, None)
+        if shared_request_ctx is None:
+            return None
+        request = shared_request_ctx['request']
+        p_request[request_hash] = private_request_ctx = self._new_private_request_context(
+            request, name, p_request._context_class
+        )
+        # the request holds it, and it gets deleted along with the shared request context
+        anchors = getattr(request.ctx, '_sptk_request_contexts', None)
+        anchor = anchors.get(id(self), None) if anchors else None
+        if anchor is None:
+            anchor = self._anchor_request_context(request, shared_request_ctx)
+        anchor.private.append((p_request, private_request_ctx))
+        return private_request_ctx
+
+    def _new_private_request_context(self, request, name, context_class=None):
+        items = {'request': request, 'id': "private request context for {} on request {}".format(name, id(request))}
+        if context_class is not None:
+            # the plugin declared its request context fields
+            return context_class(self, None, items)
+        layout = None
+        if self._request_context_layouts is not None:
+            layout = self._request_context_layouts.get(name, None)
+            if layout is None:
+                self._request_context_layouts[name] = layout = KeyLayout(items.keys())
+        if self._request_context_pool is not None:
+            return self._request_context_pool.acquire(self, None, items, layout)
+        if layout is not None:
+            return layout.new_context(self, None, items)
+        return SanicContext(self, None, items)
+
     def delete_temporary_request_context(self, request):
+        if self._request_context_var is not None:
+            binding = self._request_context_var.get()
+            if binding is not None and binding.request is request:
+                self._request_context_var.set(None)
+                self._live_request_count -= 1
+                self._pop_request_anchor(request)
+                pool = self._request_context_pool
+                if pool is not None:
+                    pool.release(binding.shared)
+                    for private_request_ctx in binding.private.values():
+                        pool.release(private_request_ctx)
+            return
         request_hash = id(request)
-        shared_context = self.shared_context
-        try:
-            _shared_requests_dict = shared_context['request']
-            del _shared_requests_dict[request_hash]
-        except KeyError:
-            pass
-        for name, _p in self._plugins_context.items():
-            if not (isinstance(_p, SanicContext) and 'instance' in _p and isinstance(_p['instance'], SanicPlugin)):
+        pool = self._request_context_pool
+        shared_request_ctx = self._live_request_contexts.pop(request_hash, None)
+        if pool is not None and shared_request_ctx is not None:
+            pool.release(shared_request_ctx)
+        anchor = self._pop_request_anchor(request)
+        if anchor is None:
+            return
+        # Only the plugins that used their private request context have one
+        for p_request, private_request_ctx in anchor.private:
+            p_request.pop_request_context(request_hash)
+            if pool is not None:
+                pool.release(private_request_ctx)
+
+    def detach_request_context(self, request):
+        """
+        Get a snapshot of the shared request context for a request, to use in
+        a background task that outlives the request. A plugin's own request
+        context can be detached with context.for_request(request).snapshot().
+        See SanicContext.snapshot()
+        :param request: a request the realm has request contexts for
+        :return: the snapshot
+        :rtype: SanicContext
+        """
+        if self._request_context_var is not None:
+            shared_request_ctx = self._get_shared_request_context(request)
+            if shared_request_ctx is None:
+                raise KeyError(id(request))
+            return shared_request_ctx.snapshot()
+        return self._live_request_contexts[id(request)].snapshot()
+
+    def publish_shared_buffer(self, name, data, format=None):
+        """
+        Copy a read-mostly table into shared memory, so all of the app's worker
+        processes read one copy of it, from context.shared.buffers[name].
+        Publishing the name again swaps every worker to the new version.
+        See SharedBuffers.publish()
+        :param name: the name of the buffer
+        :param data: a bytes-like object, like bytes, an array.array or a memoryview
+        :param format: the struct format of the buffer's items, defaults to the format of data
+        :return: the new version of the buffer
+        :rtype: int
+        """
+        buffers = self._shared_buffers
+        first = not buffers._published
+        version = buffers.publish(name, data, format)
+        if self._running:
+            # A worker publishing while it serves frees them when it stops, see _on_before_server_stop
+            self._serving_buffer_names.add(name)
+        elif first:
+            # Free the shared memory when the main process stops
+            app = self._app
+            if isinstance(app, Blueprint) and getattr(app, '_apps', None):
+                # the blueprint was already registered, so its future listeners were already applied
+                for a in app._apps:
+                    a.listener('main_process_stop')(self._on_main_process_stop)
+            else:
+                app.listener('main_process_stop')(self._on_main_process_stop)
+        return version
+
+    def shared_buffer(self, name):
+        """
+        :return: a read-only, zero-copy view of the current version of a shared buffer
+        :rtype: memoryview
+        :raises KeyError: if no buffer was published with that name
+        """
+        return self._shared_buffers[name]
+
+    def _on_main_process_stop(self, app, loop):
+        self._shared_buffers.unlink()
+
+    def live_request_contexts(self):
+        """
+        :return: how many requests this realm is holding request contexts for
+        :rtype: int
+        """
+        if self._request_context_var is not None:
+            # Counted as they are bound and deleted, one that is never deleted stays in the count
+            return self._live_request_count
+        return len(self._live_request_contexts)
+
+    def sweep_request_contexts(self, max_age):
+        """
+        Evict the request contexts of requests that started more than max_age
+        seconds ago. Those are orphans, left behind by a request whose
+        response path never ran, while something still holds the request.
+        Requests that are still being handled are never evicted, however
+        long they run. The evicted contexts are not put back in the context
+        pool, because they could still be in use.
+        In contextvars mode, request contexts go away with the request's
+        task, the realm doesn't keep them, so there is nothing to sweep.
+        A realm on a Blueprint doesn't sweep either, its middleware can't
+        tell a request that is still running from one whose response path
+        never ran. Its request contexts still go away with their requests.
+        :param max_age: in seconds
+        :return: the number of requests whose contexts were evicted
+        :rtype: int
+        """
+        if isinstance(self._app, Blueprint):
+            return 0
+        oldest = monotonic() - max_age
+        evicted = 0
+        in_flight = self._requests_in_flight
+        for request_hash, shared_request_ctx in list(self._live_request_contexts.items()):
+            if request_hash in in_flight:
                 continue
-            if not ('context' in _p and isinstance(_p['context'], SanicContext)):
+            request = shared_request_ctx.get('request', None)
+            anchors = getattr(request.ctx, '_sptk_request_contexts', None) if request is not None else None
+            anchor = anchors.get(id(self), None) if anchors else None
+            if anchor is not None and anchor.created >= oldest:
                 continue
-            _p_context = _p['context']
-            try:
-                _p_requests_dict = _p_context['request']
-                del _p_requests_dict[request_hash]
-            except KeyError:
-                pass
+            self._live_request_contexts.pop(request_hash, None)
+            if request is not None:
+                anchor = self._pop_request_anchor(request)
+            for p_request, _private_request_ctx in anchor.private if anchor is not None else ():
+                p_request.pop_request_context(request_hash)
+            evicted += 1
+        return evicted
+
+    async def _run_request_context_sweeper(self, interval, max_age):
+        while True:
+            _ = await sleep(interval)  # noqa: F841
+            evicted = self.sweep_request_contexts(max_age)
+            if evicted:
+                logger.warning(
+                    "SPTK evicted {:d} orphaned request contexts, older than {}s. {:d} are still live.".format(
+                        evicted, max_age, self.live_request_contexts()
+                    )
+                )
 
     async def _handle_request(self, real_handle, request, write_callback, stream_callback):
         cancelled = False
+        request_hash = id(request)
+        # The sweeper leaves the contexts of requests that are still running alone
+        self._requests_in_flight.add(request_hash)
         try:
             _ = await real_handle(request, write_callback, stream_callback)
         except CancelledError as ce:
@@ -543,15 +897,23 @@ class SanicPluginRealm(object):
             logger.error(str(be))
             raise
         finally:
-            # noinspection PyUnusedLocal
-            _ = await self._run_cleanup_middleware(request)  # noqa: F841
+            try:
+                # noinspection PyUnusedLocal
+                _ = await self._run_cleanup_middleware(request)  # noqa: F841
+            finally:
+                self._requests_in_flight.discard(request_hash)
             if cancelled:
                 raise cancelled
 
     async def _handle_request_21_03(self, real_handle, request):
         cancelled = False
+        handled = False
+        request_hash = id(request)
+        # The sweeper leaves the contexts of requests that are still running alone
+        self._requests_in_flight.add(request_hash)
         try:
             _ = await real_handle(request)
+            handled = True
         except CancelledError as ce:
             # We still want to run cleanup middleware, even if cancelled
             cancelled = ce
@@ -560,8 +922,23 @@ class SanicPluginRealm(object):
             logger.error(str(be))
             raise
         finally:
-            # noinspection PyUnusedLocal
-            _ = await self._run_cleanup_middleware(request)  # noqa: F841
+            # The response has been sent by now, after_response middleware
+            # takes over the request contexts and deletes them when it's done.
+            after_response = handled and self._after_response_runner is not None
+            try:
+                if self._cleanup_runner is not None:
+                    _ = await self._dispatch_cleanup_middleware(request, after_response)  # noqa: F841
+                else:
+                    # noinspection PyUnusedLocal
+                    _ = await self._run_cleanup_middleware(request, delete_context=not after_response)  # noqa: F841
+                    if after_response:
+                        await self._dispatch_after_response_middleware(request)
+            finally:
+                self._requests_in_flight.discard(request_hash)
+            if self._request_context_var is not None:
+                # Background tasks keep their own copy of the binding. Unbind it
+                # here, so the next request on this connection starts clean.
+                self._request_context_var.set(None)
             if cancelled:
                 raise cancelled
 
@@ -576,7 +953,7 @@ class SanicPluginRealm(object):
             raise ServerError("Toolkit processing a request before App server is started.")
         self.create_temporary_request_context(request)
         if self._pre_request_middleware:
-            for (_pri, _ins, middleware) in self._pre_request_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._pre_request_middleware:
                 response = middleware(request)
                 if isawaitable(response):
                     response = await response
@@ -590,7 +967,7 @@ class SanicPluginRealm(object):
                 if response:
                     return response
         if self._post_request_middleware:
-            for (_pri, _ins, middleware) in self._post_request_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._post_request_middleware:
                 response = middleware(request)
                 if isawaitable(response):
                     response = await response
@@ -619,7 +996,7 @@ class SanicPluginRealm(object):
                 raise RuntimeError("Sanic Plugin Toolkit received a request before Sanic server is started.")
         self.create_temporary_request_context(request)
         if self._pre_request_middleware:
-            for (_pri, _ins, middleware) in self._pre_request_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._pre_request_middleware:
                 response = middleware(request)
                 if isawaitable(response):
                     response = await response
@@ -636,7 +1013,7 @@ class SanicPluginRealm(object):
                 if response:
                     return response
         if self._post_request_middleware:
-            for (_pri, _ins, middleware) in self._post_request_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._post_request_middleware:
                 response = middleware(request)
                 if isawaitable(response):
                     response = await response
@@ -668,38 +1045,29 @@ class SanicPluginRealm(object):
         if realm_request_middleware_started:
             return None
         shared_req_context['realm_request_middleware_started'] = True
-        if self._pre_request_middleware:
-            for (_pri, _ins, middleware) in self._pre_request_middleware:
-                response = middleware(request)
-                if isawaitable(response):
-                    response = await response
-                if response:
-                    return response
-        app = self._app
-        named_middleware = app.named_request_middleware.get(request_name, deque())
-        applicable_middleware = app.request_middleware + named_middleware
+        chains = self._request_middleware_chains
+        if chains is None:
+            self._compile_middleware_chains(self._app)
+            chains = self._request_middleware_chains
+        chain_pair = chains.get(request_name, None)
+        (chain, app_free_chain) = chains[None] if chain_pair is None else chain_pair
         # request.request_middleware_started is meant as a stop-gap solution
         # until RFC 1630 is adopted
-        if applicable_middleware and not request.request_middleware_started:
+        if request.request_middleware_started:
+            chain = app_free_chain
+        elif chain is not app_free_chain:
             request.request_middleware_started = True
-            for middleware in applicable_middleware:
-                response = middleware(request)
-                if isawaitable(response):
-                    response = await response
-                if response:
-                    return response
-        if self._post_request_middleware:
-            for (_pri, _ins, middleware) in self._post_request_middleware:
-                response = middleware(request)
-                if isawaitable(response):
-                    response = await response
-                if response:
-                    return response
+        for (middleware, awaits) in chain:
+            response = middleware(request)
+            if awaits or isawaitable(response):
+                response = await response
+            if response:
+                return response
         return None
 
     async def _run_response_middleware_18_12(self, request, response):
         if self._pre_response_middleware:
-            for (_pri, _ins, middleware) in self._pre_response_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._pre_response_middleware:
                 _response = middleware(request, response)
                 if isawaitable(_response):
                     _response = await _response
@@ -715,7 +1083,7 @@ class SanicPluginRealm(object):
                     response = _response
                     break
         if self._post_response_middleware:
-            for (_pri, _ins, middleware) in self._post_response_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._post_response_middleware:
                 _response = middleware(request, response)
                 if isawaitable(_response):
                     _response = await _response
@@ -726,7 +1094,7 @@ class SanicPluginRealm(object):
 
     async def _run_response_middleware_19_12(self, request, response, request_name=None):
         if self._pre_response_middleware:
-            for (_pri, _ins, middleware) in self._pre_response_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._pre_response_middleware:
                 _response = middleware(request, response)
                 if isawaitable(_response):
                     _response = await _response
@@ -745,7 +1113,7 @@ class SanicPluginRealm(object):
                     response = _response
                     break
         if self._post_response_middleware:
-            for (_pri, _ins, middleware) in self._post_response_middleware:
+            for (_pri, _ins, middleware, *_opts) in self._post_response_middleware:
                 _response = middleware(request, response)
                 if isawaitable(_response):
                     _response = await _response
@@ -755,52 +1123,99 @@ class SanicPluginRealm(object):
         return response
 
     async def _run_response_middleware_21_03(self, request, response, request_name=None):
-        if self._pre_response_middleware:
-            for (_pri, _ins, middleware) in self._pre_response_middleware:
+        chains = self._response_middleware_chains
+        if chains is None:
+            # a response can come before any request middleware, like a 404
+            self._compile_middleware_chains(self._app)
+            chains = self._response_middleware_chains
+        segments = chains.get(request_name, None)
+        if segments is None:
+            segments = chains[None]
+        # Each segment (pre, app+named, post) stops at its first middleware
+        # that returns a response, then the next segment carries on.
+        for segment in segments:
+            for (middleware, awaits) in segment:
                 _response = middleware(request, response)
-                if isawaitable(_response):
-                    _response = await _response
-                if _response:
-                    response = _response
-                    if isinstance(response, BaseHTTPResponse):
-                        response = request.stream.respond(response)
-                    break
-        app = self._app
-        named_middleware = app.named_response_middleware.get(request_name, deque())
-        applicable_middleware = app.response_middleware + named_middleware
-        if applicable_middleware:
-            for middleware in applicable_middleware:
-                _response = middleware(request, response)
-                if isawaitable(_response):
-                    _response = await _response
-                if _response:
-                    response = _response
-                    if isinstance(response, BaseHTTPResponse):
-                        response = request.stream.respond(response)
-                    break
-        if self._post_response_middleware:
-            for (_pri, _ins, middleware) in self._post_response_middleware:
-                _response = middleware(request, response)
-                if isawaitable(_response):
+                if awaits or isawaitable(_response):
                     _response = await _response
                 if _response:
                     response = _response
                     if isinstance(response, BaseHTTPResponse):
                         response = request.stream.respond(response)
                     break
+        if self._after_response_runner is not None:
+            self._remember_response(request, response)
         return response
 
-    async def _run_cleanup_middleware(self, request):
+    def _get_shared_request_context(self, request):
+        if self._request_context_var is not None:
+            binding = self._request_context_var.get()
+            return binding.shared if binding is not None and binding.request is request else None
+        shared_requests_dict = self.shared_context.get('request', None)
+        return shared_requests_dict.get(id(request), None) if shared_requests_dict else None
+
+    def _remember_response(self, request, response):
+        # Keep the final response for the after_response middleware
+        shared_req_context = self._get_shared_request_context(request)
+        if shared_req_context is not None:
+            shared_req_context['realm_response'] = response
+
+    async def _dispatch_after_response_middleware(self, request):
+        chain = self._get_plugin_middleware_chain('after_response', request.name)
+        if not chain:
+            self.delete_temporary_request_context(request)
+            return
+        shared_req_context = self._get_shared_request_context(request)
+        response = shared_req_context.get('realm_response', None) if shared_req_context is not None else None
+        submitted = await self._after_response_runner.submit(
+            self._run_after_response_middleware(chain, request, response)
+        )
+        if not submitted:
+            # It was dropped, so it won't delete the request contexts itself
+            self.delete_temporary_request_context(request)
+
+    async def _run_after_response_middleware(self, chain, request, response):
+        try:
+            _ = await run_after_response_chain(chain, request, response)  # noqa: F841
+        finally:
+            self.delete_temporary_request_context(request)
+
+    async def _dispatch_cleanup_middleware(self, request, after_response):
+        if self._get_plugin_middleware_chain('cleanup', request.name):
+            submitted = await self._cleanup_runner.submit(
+                self._run_background_cleanup_middleware(request, after_response)
+            )
+            if submitted:
+                return
+        # Nothing to run in the background, or it was dropped
+        if after_response:
+            await self._dispatch_after_response_middleware(request)
+        else:
+            self.delete_temporary_request_context(request)
+
+    async def _run_background_cleanup_middleware(self, request, after_response):
+        # The request contexts are only deleted once the cleanup is done
+        try:
+            _ = await self._run_cleanup_middleware(request, delete_context=False)  # noqa: F841
+        except BaseException:
+            self.delete_temporary_request_context(request)
+            raise
+        if after_response:
+            await self._dispatch_after_response_middleware(request)
+        else:
+            self.delete_temporary_request_context(request)
+
+    async def _run_cleanup_middleware(self, request, delete_context=True):
         return_this = None
-        if self._cleanup_middleware:
-            for (_pri, _ins, middleware) in self._cleanup_middleware:
-                response = middleware(request)
-                if isawaitable(response):
-                    response = await response
-                if response:
-                    return_this = response
-                    break
-        self.delete_temporary_request_context(request)
+        for (middleware, awaits) in self._get_plugin_middleware_chain('cleanup', request.name):
+            response = middleware(request)
+            if awaits or isawaitable(response):
+                response = await response
+            if response:
+                return_this = response
+                break
+        if delete_context:
+            self.delete_temporary_request_context(request)
         return return_this
 
     def _on_server_start(self, app, loop):
@@ -817,14 +1232,229 @@ class SanicPluginRealm(object):
         self._pre_response_middleware = tuple(sorted(self._pre_response_middleware))
         self._post_response_middleware = tuple(sorted(self._post_response_middleware))
         self._cleanup_middleware = tuple(sorted(self._cleanup_middleware))
+        self._after_response_middleware = tuple(sorted(self._after_response_middleware))
+        budget = app.config.get(SPTK_MIDDLEWARE_BUDGET_KEY, None)
+        self._middleware_budget = float(budget) if budget else None
+        if app.config.get(SPTK_REQUEST_CONTEXTVARS_KEY, False):
+            self._use_request_contextvars()
+        else:
+            # Set up shared_context.request once, so per-request setup and
+            # teardown only touch the live request contexts dict behind it
+            self.shared_context['request'] = RequestContextRegistry(
+                self, None, {'id': 'shared request contexts'}, live=self._live_request_contexts
+            )
+        pool_size = app.config.get(SPTK_REQUEST_CONTEXT_POOL_SIZE_KEY, 0)
+        if pool_size:
+            pool_debug = app.config.get(SPTK_REQUEST_CONTEXT_POOL_DEBUG_KEY, getattr(app, 'debug', False))
+            self._request_context_pool = ContextPool(pool_size, debug=bool(pool_debug))
+        if app.config.get(SPTK_REQUEST_CONTEXT_SHARED_KEYS_KEY, False):
+            # Sibling request contexts share their key layout, and keep only their values
+            self._request_context_layouts = {None: KeyLayout(('request', 'id'))}
+        sweep_interval = app.config.get(SPTK_REQUEST_CONTEXT_SWEEP_INTERVAL_KEY, None)
+        if sweep_interval and self._request_context_var is None and not isinstance(self._app, Blueprint):
+            max_age = app.config.get(SPTK_REQUEST_CONTEXT_MAX_AGE_KEY, 300.0)
+            self._request_context_sweeper = loop.create_task(
+                self._run_request_context_sweeper(float(sweep_interval), float(max_age))
+            )
+        # Without stats, the chains are compiled without the instrumentation wrappers
+        self._middleware_stats = [] if app.config.get(SPTK_MIDDLEWARE_STATS_KEY, False) else None
+        self._compile_plugin_middleware_chains(app)
+        if self._after_response_middleware:
+            max_tasks = app.config.get(SPTK_AFTER_RESPONSE_MAX_TASKS_KEY, 128)
+            if isinstance(self._app, Blueprint):
+                # Blueprint after_response middleware is handed over inside the response
+                # middleware, before the response is sent, so a full pool must not run it inline
+                self._after_response_runner = BackgroundRunner(max_tasks, max_tasks, 'drop')
+            else:
+                self._after_response_runner = BackgroundRunner(max_tasks)
+        cleanup_max_tasks = app.config.get(SPTK_CLEANUP_MAX_TASKS_KEY, None)
+        if cleanup_max_tasks and self._cleanup_middleware and not isinstance(self._app, Blueprint):
+            # Blueprint cleanup middleware is run inside the response middleware, so it stays inline
+            cleanup_max_queued = app.config.get(SPTK_CLEANUP_QUEUE_SIZE_KEY, 0)
+            cleanup_overflow = app.config.get(SPTK_CLEANUP_OVERFLOW_KEY, 'inline')
+            self._cleanup_runner = BackgroundRunner(cleanup_max_tasks, cleanup_max_queued, cleanup_overflow)
+        # The app's own middleware is merged in on the first request, see _compile_middleware_chains()
+        self._request_middleware_chains = None
+        self._response_middleware_chains = None
         self._running = True
 
+    def _compile_plugin_middleware_chains(self, app):
+        """
+        Build the chain of plugin middleware for each phase, for each named
+        route in the app. Middleware with `include` or `exclude` rules are
+        left out of the routes they don't apply to. When the route alone
+        can't decide the rules, the middleware is guarded and the rules are
+        checked on each request. Middleware with a timeout are wrapped so they
+        are cancelled when they run too long, and when middleware stats are
+        turned on, every middleware is wrapped to record its runs. Middleware in the same
+        concurrent group and priority are gathered into one entry, where the
+        first of them in the chain would be. When the app sets a total
+        middleware budget, each plugin request middleware entry draws on it.
+        The chain for the route name None is used
+        for unnamed requests, and for routes without their own chain.
+        :param app: the Sanic app being served
+        :type app: Sanic
+        :return: Nothing
+        :rtype: None
+        """
+        routes_by_name = {}
+        for route in app.router.routes:
+            routes_by_name.setdefault(route.name, []).append(route)
+
+        def _route_chain(classified, routes):
+            chain = []
+            groups = {}
+            for (middleware, awaits), m in classified:
+                route_filter = m.route_filter
+                if route_filter is not None:
+                    decision = route_filter.decide(routes)
+                    if decision is False:
+                        continue
+                    elif decision is None:
+                        (middleware, awaits) = route_filter.guard(middleware, awaits)
+                if m.group is None:
+                    chain.append((middleware, awaits))
+                    continue
+                # A concurrent group takes the place of its first member
+                group_key = (m.priority, m.group)
+                members = groups.get(group_key, None)
+                if members is None:
+                    groups[group_key] = members = []
+                    chain.append(members)
+                members.append((middleware, awaits))
+            return tuple(concurrent_group(c) if isinstance(c, list) else c for c in chain)
+
+        budget_on_timeout = app.config.get(SPTK_BUDGET_ON_TIMEOUT_KEY, '503')
+        assert budget_on_timeout in TIMEOUT_POLICIES, "{} must be one of {}.".format(
+            SPTK_BUDGET_ON_TIMEOUT_KEY, ", ".join(TIMEOUT_POLICIES)
+        )
+
+        def _budget_chain(chain):
+            # A concurrent group draws on the budget once, as a whole
+            get_request_context = self._get_shared_request_context
+            return tuple(budget_limited(m, a, get_request_context, budget_on_timeout) for (m, a) in chain)
+
+        def _classify(phase, m):
+            (middleware, awaits) = classify_middleware(m.middleware)
+            if m.timeout is not None:
+                (middleware, awaits) = time_limited(middleware, awaits, m.timeout, m.on_timeout)
+            if self._middleware_stats is not None:
+                (_r, plugin_name, _u) = m.plugin.find_plugin_registration(self)
+                name = getattr(m.middleware, '__name__', repr(m.middleware))
+                stats = MiddlewareStats(plugin_name, phase, name)
+                self._middleware_stats.append(stats)
+                (middleware, awaits) = instrumented(middleware, awaits, stats)
+            return middleware, awaits
+
+        plugin_chains = {}
+        for phase in MIDDLEWARE_PHASES:
+            entries = getattr(self, '_{}_middleware'.format(phase))
+            classified = [(_classify(phase, m), m) for m in entries]
+            plan = {None: _route_chain(classified, None)}
+            if any(m.route_filter is not None for (_c, m) in classified):
+                for request_name, routes in routes_by_name.items():
+                    plan[request_name] = _route_chain(classified, routes)
+            if self._middleware_budget is not None and phase in ('pre_request', 'post_request'):
+                plan = {request_name: _budget_chain(chain) for request_name, chain in plan.items()}
+            plugin_chains[phase] = plan
+        self._plugin_middleware_chains = plugin_chains
+
+    def _use_request_contextvars(self):
+        """
+        Switch the realm to keeping request contexts in a ContextVar, bound
+        to each request's task, instead of in dicts keyed by id(request).
+        Lookups through shared_context.request and the plugins' private
+        request contexts keep working, for the request that is running.
+        """
+        self._request_context_var = ContextVar('sptk_request_context_{}'.format(id(self)), default=None)
+        self.shared_context['request'] = SharedRequestContexts(self, None, {'id': 'shared request contexts'})
+
+    def stats(self):
+        """
+        Get the recorded stats for each plugin middleware, when the app has
+        SPTK_MIDDLEWARE_STATS turned on. The stats are for this worker only.
+        :return: one dict per middleware per phase, with the plugin name,
+                 phase, middleware name, count, errors, total_time, and the
+                 histogram as (bucket upper bound in seconds, count) pairs.
+        :rtype: list
+        """
+        if self._middleware_stats is None:
+            return []
+        return [s.to_dict() for s in self._middleware_stats]
+
+    def _get_plugin_middleware_chain(self, phase, request_name):
+        plan = self._plugin_middleware_chains[phase]
+        chain = plan.get(request_name, None)
+        return plan[None] if chain is None else chain
+
+    def _compile_middleware_chains(self, app):
+        """
+        Merge the frozen plugin middleware with the app's own request and
+        response middleware, into one chain for each named route.
+        The request chains are stored as a (chain, app_free_chain) pair, the
+        second one is used when the app middleware has already been started.
+        The response chains are stored as a tuple of non-empty segments.
+        Every middleware in a chain is a (middleware, awaits) pair, see
+        classify_middleware().
+        This runs on the first request, not at server start, so the app
+        middleware registered by later startup listeners is in the chains.
+        :param app: the Sanic app this realm is patched into
+        :type app: Sanic
+        :return: Nothing
+        :rtype: None
+        """
+        plugin_chains = self._plugin_middleware_chains
+        get_plugin_chain = self._get_plugin_middleware_chain
+        app_request = tuple(classify_middleware(m) for m in app.request_middleware)
+        app_response = tuple(classify_middleware(m) for m in app.response_middleware)
+
+        def _request_chain(request_name):
+            pre_request = get_plugin_chain('pre_request', request_name)
+            post_request = get_plugin_chain('post_request', request_name)
+            named_middleware = app.named_request_middleware.get(request_name, ())
+            applicable = app_request + tuple(classify_middleware(m) for m in named_middleware)
+            app_free_chain = pre_request + post_request
+            if not applicable:
+                return app_free_chain, app_free_chain
+            return pre_request + applicable + post_request, app_free_chain
+
+        def _response_chain(request_name):
+            pre_response = get_plugin_chain('pre_response', request_name)
+            post_response = get_plugin_chain('post_response', request_name)
+            named_middleware = app.named_response_middleware.get(request_name, ())
+            named_middleware = tuple(classify_middleware(m) for m in named_middleware)
+            segments = (pre_response, app_response + named_middleware, post_response)
+            return tuple(s for s in segments if s)
+
+        request_names = {None}
+        request_names.update(app.named_request_middleware.keys())
+        request_names.update(plugin_chains['pre_request'].keys(), plugin_chains['post_request'].keys())
+        response_names = {None}
+        response_names.update(app.named_response_middleware.keys())
+        response_names.update(plugin_chains['pre_response'].keys(), plugin_chains['post_response'].keys())
+        self._request_middleware_chains = {n: _request_chain(n) for n in request_names}
+        self._response_middleware_chains = {n: _response_chain(n) for n in response_names}
+
     def _on_after_server_start(self, app, loop):
         if not self._running:
             # Missed before_server_start event
             # Run startup now!
             self._on_server_start(app, loop)
 
+    async def _on_before_server_stop(self, app, loop):
+        if self._serving_buffer_names:
+            self._shared_buffers.unlink(self._serving_buffer_names)
+            self._serving_buffer_names.clear()
+        if self._request_context_sweeper is not None:
+            self._request_context_sweeper.cancel()
+            self._request_context_sweeper = None
+        # Let the background middleware tasks finish, before the loop goes away.
+        # Cleanup tasks can still hand work to the after_response runner.
+        if self._cleanup_runner is not None:
+            _ = await self._cleanup_runner.drain()  # noqa: F841
+        if self._after_response_runner is not None:
+            _ = await self._after_response_runner.drain()  # noqa: F841
+
     async def _startup(self, app, real_startup):
         _ = await real_startup()
         # Patch app _after_ Touchup is done.
@@ -856,59 +1486,61 @@ class SanicPluginRealm(object):
         async def run_bp_pre_request_mw(request):
             nonlocal _spf
             _spf.create_temporary_request_context(request)
-            if _spf._pre_request_middleware:
-                for (_pri, _ins, middleware) in _spf._pre_request_middleware:
-                    response = middleware(request)
-                    if isawaitable(response):
-                        response = await response
-                    if response:
-                        return response
+            for (middleware, awaits) in _spf._get_plugin_middleware_chain('pre_request', request.name):
+                response = middleware(request)
+                if awaits or isawaitable(response):
+                    response = await response
+                if response:
+                    return response
 
         async def run_bp_post_request_mw(request):
             nonlocal _spf
-            if _spf._post_request_middleware:
-                for (_pri, _ins, middleware) in _spf._post_request_middleware:
-                    response = middleware(request)
-                    if isawaitable(response):
-                        response = await response
-                    if response:
-                        return response
+            for (middleware, awaits) in _spf._get_plugin_middleware_chain('post_request', request.name):
+                response = middleware(request)
+                if awaits or isawaitable(response):
+                    response = await response
+                if response:
+                    return response
 
         async def run_bp_pre_response_mw(request, response):
             nonlocal _spf
             altered = False
-            if _spf._pre_response_middleware:
-                for (_pri, _ins, middleware) in _spf._pre_response_middleware:
-                    _response = middleware(request, response)
-                    if isawaitable(_response):
-                        _response = await _response
-                    if _response:
-                        response = _response
-                        altered = True
-                        break
+            for (middleware, awaits) in _spf._get_plugin_middleware_chain('pre_response', request.name):
+                _response = middleware(request, response)
+                if awaits or isawaitable(_response):
+                    _response = await _response
+                if _response:
+                    response = _response
+                    altered = True
+                    break
             if altered:
                 return response
 
         async def run_bp_post_response_mw(request, response):
             nonlocal _spf
             altered = False
-            if _spf._post_response_middleware:
-                for (_pri, _ins, middleware) in _spf._post_response_middleware:
-                    _response = middleware(request, response)
-                    if isawaitable(_response):
-                        _response = await _response
-                    if _response:
-                        response = _response
-                        altered = True
-                        break
-            if self._cleanup_middleware:
-                for (_pri, _ins, middleware) in self._cleanup_middleware:
-                    response2 = middleware(request)
-                    if isawaitable(response2):
-                        response2 = await response2
-                    if response2:
-                        break
-            _spf.delete_temporary_request_context(request)
+            for (middleware, awaits) in _spf._get_plugin_middleware_chain('post_response', request.name):
+                _response = middleware(request, response)
+                if awaits or isawaitable(_response):
+                    _response = await _response
+                if _response:
+                    response = _response
+                    altered = True
+                    break
+            for (middleware, awaits) in _spf._get_plugin_middleware_chain('cleanup', request.name):
+                response2 = middleware(request)
+                if awaits or isawaitable(response2):
+                    response2 = await response2
+                if response2:
+                    break
+            if _spf._after_response_runner is not None:
+                # A blueprint can't see the response being sent, so this is
+                # dispatched as late as the blueprint middleware allows. The
+                # middleware can start before the send is done, see README.
+                _spf._remember_response(request, response)
+                await _spf._dispatch_after_response_middleware(request)
+            else:
+                _spf.delete_temporary_request_context(request)
             if altered:
                 return response
 
@@ -943,14 +1575,38 @@ class SanicPluginRealm(object):
         self._app = app
         self._loop = None
         self._plugin_names = set()
+        # id(request) -> shared request context, for every request with contexts
+        self._live_request_contexts = WeakValueDictionary()
+        # in contextvars mode, nothing is kept per request, only how many have contexts
+        self._live_request_count = 0
+        # id(request) for every request the realm's handle_request is running
+        self._requests_in_flight = set()
+        self._request_context_var = None
+        self._request_context_pool = None
+        # None, or the KeyLayout of the shared (None) and each plugin's request contexts
+        self._request_context_layouts = None
+        self._request_context_sweeper = None
         # these deques get replaced with frozen tuples at runtime
         self._pre_request_middleware = deque()
         self._post_request_middleware = deque()
         self._pre_response_middleware = deque()
         self._post_response_middleware = deque()
         self._cleanup_middleware = deque()
+        self._after_response_middleware = deque()
+        self._after_response_runner = None
+        self._cleanup_runner = None
+        self._middleware_budget = None
+        self._middleware_stats = None
+        # these get compiled at runtime, from the frozen middleware tuples
+        self._plugin_middleware_chains = {phase: {None: ()} for phase in MIDDLEWARE_PHASES}
+        self._request_middleware_chains = None
+        self._response_middleware_chains = None
         self._contexts = SanicContext(self, None)
-        self._contexts['shared'] = SanicContext(self, None, {'app': app})
+        self._shared_buffers = SharedBuffers()
+        # names published while serving, freed when this worker stops
+        self._serving_buffer_names = set()
+        shared_context_class = keyed_context_class('SharedContext', SHARED_CONTEXT_KEYS)
+        self._contexts['shared'] = shared_context_class(self, None, {'app': app, 'buffers': self._shared_buffers})
         self._contexts['_plugins'] = SanicContext(self, None, {'sanic_plugin_toolkit': self})
         return self
 
@@ -994,6 +1650,7 @@ class SanicPluginRealm(object):
             self._patch_blueprint(bp)
             bp.listener('before_server_start')(self._on_server_start)
             bp.listener('after_server_start')(self._on_after_server_start)
+            bp.listener('before_server_stop')(self._on_before_server_stop)
         else:
             if hasattr(Sanic, "__fake_slots__"):
                 _slots = list(Sanic.__fake_slots__)
@@ -1010,6 +1667,7 @@ class SanicPluginRealm(object):
                 app.config[APP_CONFIG_INSTANCE_KEY] = self
             app.listener('before_server_start')(self._on_server_start)
             app.listener('after_server_start')(self._on_after_server_start)
+            app.listener('before_server_stop')(self._on_before_server_stop)
         config = getattr(app, 'config', None)
         if config:
             load_ini = config.get(SPTK_LOAD_INI_KEY, True)
@@ -1035,7 +1693,8 @@ class SanicPluginRealm(object):
             raise RuntimeError("Cannot call __getstate__ on an SPTK app that is already running.")
         state_dict = {}
         for s in SanicPluginRealm.__slots__:
-            if s in ('_running', '_loop'):
+            # there are no live request contexts before running, and weakrefs can't be pickled
+            if s in ('_running', '_loop', '_live_request_contexts'):
                 continue
             state_dict[s] = getattr(self, s)
         return state_dict
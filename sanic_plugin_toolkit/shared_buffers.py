@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""
+Named, read-only buffers kept in shared memory, for read-mostly tables
+that every Sanic worker process needs, so they are held once instead of
+once per worker. Workers read them through zero-copy memoryviews.
+"""
+import struct
+
+from hashlib import sha1
+from secrets import token_hex
+
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # pragma: no cover
+    # multiprocessing.shared_memory is new in Python 3.8
+    shared_memory = None
+
+# A name's pointer segment holds its current version, as one aligned 8-byte
+# integer, so it is swapped with a single store. Version 0 means unpublished.
+_POINTER_SIZE = 8
+# Each version's segment starts with the payload's length and struct format
+_HEADER = struct.Struct('<Q8s')
+
+
+class SharedBuffers(object):
+    """
+    The shared memory buffers of a realm, by name. Each publish() copies the
+    data into a new shared memory segment for the next version of the name,
+    then swaps the name's pointer to that version. Readers get a read-only
+    memoryview of the current version, and never see a partly written one.
+    A process re-attaches only when the version has changed. A version that
+    was replaced is unlinked, its memory is freed when the last process
+    that has it attached lets go of it.
+
+    Every process that has the same `token` sees the same buffers. The token
+    is kept when the realm is pickled or forked into the worker processes.
+
+    Each name should only be published from one process at a time. The
+    pointer is re-read before the swap, so it never goes back to an older
+    version, and the segments of the versions it skipped are unlinked. But
+    the check and the swap are not one atomic step, so two processes that
+    publish the same name at the same moment can still leave the older of
+    the two current.
+    """
+
+    __slots__ = ('token', '_pointers', '_attached', '_retired', '_published')
+
+    def __init__(self, token=None):
+        self.token = token or token_hex(4)
+        # name -> (SharedMemory, pointer memoryview)
+        self._pointers = {}
+        # name -> (version, SharedMemory, payload memoryview)
+        self._attached = {}
+        # replaced segments, that are closed once nothing uses their memory
+        self._retired = []
+        # names published from this process
+        self._published = set()
+
+    def __reduce__(self):
+        # The attached segments belong to this process, the other one attaches its own
+        return (SharedBuffers, (self.token,))
+
+    def _segment_name(self, name, version=None):
+        # POSIX shared memory names can be short (31 characters on macOS), so the name is hashed
+        digest = sha1(name.encode('utf-8')).hexdigest()[:8]
+        if version is None:
+            return 'sptk{}{}'.format(self.token, digest)
+        return 'sptk{}{}_{}'.format(self.token, digest, version)
+
+    def _pointer(self, name, create=False):
+        pointer = self._pointers.get(name, None)
+        if pointer is not None:
+            return pointer[1]
+        segment_name = self._segment_name(name)
+        try:
+            segment = shared_memory.SharedMemory(segment_name)
+        except FileNotFoundError:
+            if not create:
+                return None
+            try:
+                segment = shared_memory.SharedMemory(segment_name, create=True, size=_POINTER_SIZE)
+            except FileExistsError:
+                # another process made it first
+                segment = shared_memory.SharedMemory(segment_name)
+        view = segment.buf[:_POINTER_SIZE].cast('Q')
+        self._pointers[name] = (segment, view)
+        return view
+
+    def publish(self, name, data, format=None):
+        """
+        Copy data into shared memory, as the new version of the named buffer.
+        :param name: the name of the buffer
+        :param data: a bytes-like object, like bytes, an array.array or a memoryview
+        :param format: the struct format of the buffer's items, the views are
+                       cast to it. Defaults to the format of data.
+        :return: the new version, or the newer one that another process published meanwhile
+        :rtype: int
+        """
+        if shared_memory is None:  # pragma: no cover
+            raise RuntimeError("Shared buffers need multiprocessing.shared_memory, from Python 3.8.")
+        assert isinstance(name, str) and name, "The shared buffer name must be a string."
+        source = memoryview(data)
+        if format is None:
+            format = source.format
+        source = source.cast('B') if source.ndim != 1 or source.format != 'B' else source
+        encoded_format = format.encode('ascii')
+        assert len(encoded_format) <= 8, "The shared buffer format can't be more than 8 characters."
+        try:
+            # the readers' views are cast to it, so it must be a format that memoryview can cast to
+            item_size = struct.calcsize(format)
+            _ = memoryview(bytes(item_size)).cast(format)  # noqa: F841
+        except (TypeError, ValueError, struct.error):
+            raise ValueError("Shared buffer format {!r} is not a native single item format.".format(format))
+        assert len(source) % item_size == 0, "The data isn't a whole number of {!r} items.".format(format)
+        pointer = self._pointer(name, create=True)
+        previous = version = pointer[0]
+        while True:
+            version += 1
+            try:
+                segment = shared_memory.SharedMemory(
+                    self._segment_name(name, version), create=True, size=_HEADER.size + len(source)
+                )
+            except FileExistsError:
+                # another process is publishing this version, take the next one
+                continue
+            break
+        _HEADER.pack_into(segment.buf, 0, len(source), encoded_format)
+        segment.buf[_HEADER.size : _HEADER.size + len(source)] = source
+        self._published.add(name)
+        current = pointer[0]
+        if current > version:
+            # another process published a newer version while this one was written, it wins
+            segment.close()
+            self._unlink_segment(self._segment_name(name, version))
+            return current
+        # The swap, readers see the old version or the new one, never a partial one
+        pointer[0] = version
+        self._keep_attached(name, version, segment)
+        # the previous version, and any that lost a race with this one and were never current
+        for replaced in range(max(previous, 1), version):
+            self._unlink_segment(self._segment_name(name, replaced))
+        return version
+
+    def __getitem__(self, name):
+        """
+        :return: a read-only view of the current version of the named buffer
+        :rtype: memoryview
+        :raises KeyError: if nothing was published with that name
+        """
+        pointer = self._pointers.get(name, None)
+        pointer = pointer[1] if pointer is not None else self._pointer(name)
+        if pointer is None or pointer[0] == 0:
+            raise KeyError(name)
+        attached = self._attached.get(name, None)
+        if attached is not None and attached[0] == pointer[0]:
+            return attached[2]
+        return self._attach(name, pointer)
+
+    def __contains__(self, name):
+        pointer = self._pointer(name)
+        return pointer is not None and pointer[0] != 0
+
+    def get(self, name, default=None):
+        try:
+            return self.__getitem__(name)
+        except KeyError:
+            return default
+
+    def version(self, name):
+        """
+        :return: the current version of the named buffer, 0 if it was never published
+        :rtype: int
+        """
+        pointer = self._pointer(name)
+        return 0 if pointer is None else pointer[0]
+
+    def _attach(self, name, pointer):
+        while True:
+            version = pointer[0]
+            try:
+                segment = shared_memory.SharedMemory(self._segment_name(name, version))
+            except FileNotFoundError:
+                if pointer[0] != version:
+                    # it was replaced while this was attaching
+                    continue
+                raise KeyError(name)
+            return self._keep_attached(name, version, segment)
+
+    def _keep_attached(self, name, version, segment):
+        length, encoded_format = _HEADER.unpack_from(segment.buf, 0)
+        view = segment.buf[_HEADER.size : _HEADER.size + length]
+        format = encoded_format.rstrip(b'\0').decode('ascii')
+        if format != 'B':
+            view = view.cast(format)
+        view = view.toreadonly()
+        replaced = self._attached.get(name, None)
+        self._attached[name] = (version, segment, view)
+        if replaced is not None:
+            self._retired.append(replaced[1])
+        self._close_retired()
+        return view
+
+    def _close_retired(self):
+        retired = []
+        for segment in self._retired:
+            try:
+                segment.close()
+            except BufferError:
+                # a view of it is still in use
+                retired.append(segment)
+        self._retired = retired
+
+    @staticmethod
+    def _unlink_segment(segment_name):
+        try:
+            segment = shared_memory.SharedMemory(segment_name)
+        except FileNotFoundError:
+            return
+        segment.close()
+        segment.unlink()
+
+    def unlink(self, names=None):
+        """
+        Free the shared memory of the named buffers, in every process, once
+        they let go of it. The main process can call this when it stops. The
+        views of them that this process got from here are released.
+        :param names: the names to free, by default the ones published from this process
+        """
+        if shared_memory is None:  # pragma: no cover
+            return
+        for name in list(self._published if names is None else names):
+            pointer = self._pointer(name)
+            if pointer is not None and pointer[0]:
+                self._unlink_segment(self._segment_name(name, pointer[0]))
+            pointer_entry = self._pointers.pop(name, None)
+            attached = self._attached.pop(name, None)
+            if attached is not None:
+                # the segment can only be closed once the views of it are released
+                attached[2].release()
+                self._retired.append(attached[1])
+            if pointer_entry is not None:
+                segment, view = pointer_entry
+                view.release()
+                segment.close()
+                try:
+                    segment.unlink()
+                except FileNotFoundError:
+                    # another process already freed it
+                    pass
+            self._published.discard(name)
+        self._close_retired()
@@ -1,5 +1,18 @@
+import math
 import pickle
-from sanic_plugin_toolkit.context import SanicContext
+
+from timeit import Timer
+
+import pytest
+
+from sanic_plugin_toolkit.context import (
+    HierDict,
+    KeyLayout,
+    PluginRequestContexts,
+    SanicContext,
+    declared_context_class,
+    keyed_context_class,
+)
 
 def test_context_set_contains_get(realm):
     context = SanicContext(realm, None)
@@ -69,6 +82,19 @@ def test_context_update(realm):
     assert context['t1'] == "test1"
     assert child_context['t2'] == "test2"
 
+def test_context_update_deep(realm):
+    context = SanicContext(realm, None, {'t1': "hello 1"})
+    c2 = context.create_child_context({'t2': "hello 2"})
+    c3 = c2.create_child_context({'t3': "hello 3"})
+    assert c3['t1'] == "hello 1"
+    c3.update([('t1', "new 1"), ('t3', "new 3")], t2="new 2", t4="new 4")
+    assert dict(context.items()) == {'t1': "new 1"}
+    assert dict(c2.items()) == {'t2': "new 2"}
+    assert dict(c3.items()) == {'t3': "new 3", 't4': "new 4"}
+    assert c3['t1'] == "new 1"
+    c3.replace('t1', "newer 1")
+    assert context['t1'] == "newer 1"
+
 def test_context_del(realm):
     context = SanicContext(realm, None)
     context.set(1, "1")
@@ -106,13 +132,208 @@ def test_recursive_dict(realm):
     c2['t2'] = "hello 2"
     c3 = c2.create_child_context()
     c3['t3'] = "hello 3"
-    context._parent_hd = c3  # This is dodgy, why would anyone do this?
     exceptions = []
     try:
-        _ = c2['t4']
+        context._parent_hd = c3  # This is dodgy, why would anyone do this?
     except RuntimeError as e:
         assert len(e.args) > 0
         assert "recursive" in str(e.args[0]).lower()
         exceptions.append(e)
     finally:
         assert len(exceptions) == 1
+    # the cycle was refused when linking, so lookups still work
+    assert context._parent_hd is None
+    with pytest.raises(KeyError):
+        _ = c2['t4']
+
+
+def test_context_reparent(realm):
+    context = SanicContext(realm, None, {'t1': "hello world"})
+    c2 = context.create_child_context()
+    c3 = c2.create_child_context()
+    other = SanicContext(realm, None, {'t1': "other world"})
+    other_child = other.create_child_context()
+    assert (c2._depth, c3._depth) == (1, 2)
+    c2.reparent(other_child)
+    assert (c2._depth, c3._depth) == (2, 3)
+    assert c3['t1'] == "other world"
+    with pytest.raises(RuntimeError):
+        other.reparent(c3)
+    c2.reparent(None)
+    assert (c2._depth, c3._depth) == (0, 1)
+    with pytest.raises(KeyError):
+        _ = c3['t1']
+
+def test_context_snapshot(realm):
+    context = SanicContext(realm, None)
+    context['t1'] = "hello world"
+    child_context = context.create_child_context()
+    child_context['t2'] = ["hello 2"]
+    snap = child_context.snapshot()
+    assert snap['t1'] == "hello world"
+    assert snap['t2'] is child_context['t2']
+    child_context['t2'] = "changed"
+    del child_context['t2']
+    snap['t3'] = "only in the snapshot"
+    assert snap['t2'] == ["hello 2"]
+    assert 't3' not in child_context
+
+def test_context_lookup_cache(realm):
+    context = SanicContext(realm, None)
+    context['t1'] = "hello world"
+    c2 = context.create_child_context()
+    c3 = c2.create_child_context()
+    assert c3['t1'] == "hello world"
+    assert c3['t1'] == "hello world"  # from the lookup cache
+    assert c3.get('t2') is None
+    c2['t1'] = "hello 2"
+    context['t2'] = "hello 3"
+    assert c3['t1'] == "hello 2"
+    assert c3.get('t2') == "hello 3"
+    del c2['t1']
+    assert c3['t1'] == "hello world"
+    other = SanicContext(realm, None, {'t1': "other world"})
+    c2._parent_hd = other
+    assert c3['t1'] == "other world"
+
+def test_context_request_registry_pickle():
+    registry = PluginRequestContexts(None, None, {'id': "request contexts"}, plugin_name='TestPlugin')
+    live = SanicContext(None, None)
+    registry[1234] = live
+    registry2 = pickle.loads(pickle.dumps(registry))
+    assert registry2['id'] == "request contexts"
+    assert registry2._plugin_name == 'TestPlugin'
+    # the live request contexts aren't pickled, the copy starts with none
+    assert len(registry2._live) == 0
+    registry2[1234] = live
+    assert registry2[1234] is live
+
+def test_context_lookup_cache_declared_parent(realm):
+    class Schema(object):
+        __slots__ = ('x',)
+
+    root = SanicContext(realm, None, {'y': "from the root"})
+    parent = declared_context_class('Declared', Schema)(realm, root)
+    child = parent.create_child_context()
+    assert child.get('z') is None
+    assert child['y'] == "from the root"
+    # a miss isn't cached, and a hit is dropped when the declared context changes
+    parent['z'] = 5
+    parent['y'] = "from the parent"
+    assert child['z'] == 5
+    assert child['y'] == "from the parent"
+    del parent['y']
+    assert child['y'] == "from the root"
+    for i in range(100):
+        assert child.get('missing{}'.format(i)) is None
+    assert set(child._lookup_cache[1]) <= {'y', 'z'}
+
+def test_context_freeze(realm):
+    context = SanicContext(realm, None)
+    context['t1'] = "hello world"
+    c2 = context.create_child_context()
+    c2['t2'] = "hello 2"
+    frozen = c2.freeze()
+    assert frozen['t1'] == "hello world"
+    assert frozen.t2 == "hello 2"
+    assert 't1' in frozen and len(frozen) == 2
+    with pytest.raises(TypeError):
+        frozen['t3'] = "no"
+    with pytest.raises(TypeError):
+        frozen.t1 = "no"
+    # it's a snapshot, not a live view
+    context['t1'] = "changed"
+    assert frozen['t1'] == "hello world"
+    overlaid = c2.freeze(overlay=True)
+    overlaid.t2 = "overlay"
+    assert overlaid['t2'] == "overlay"
+    assert c2['t2'] == "hello 2"
+    assert overlaid.get('t1') == "changed"
+
+def test_context_shared_key_layout(realm):
+    layout = KeyLayout(('t1',), max_keys=3)
+    c1 = layout.new_context(realm, None, {'t1': "hello world"})
+    c2 = layout.new_context(realm, c1, {'t2': "hello 2"})
+    assert c2['t1'] == "hello world"
+    assert 't1' not in c2 and len(c2) == 1
+    c1.t3 = "hello 3"
+    # t2 and t3 were added to the layout, c1 doesn't have t2
+    assert layout._keys == ['t1', 't2', 't3']
+    assert c1.get('t2') is None and c2['t3'] == "hello 3"
+    c1['t4'] = "over max_keys"
+    assert c1['t4'] == "over max_keys" and len(layout) == 3
+    assert dict(c1.items()) == {'t1': "hello world", 't3': "hello 3", 't4': "over max_keys"}
+    del c1['t3']
+    del c1['t4']
+    with pytest.raises(KeyError):
+        del c1['t3']
+    assert repr(c1) == "SanicContext({'t1': 'hello world'})"
+    snap = c2.snapshot()
+    assert snap['t2'] == "hello 2" and snap['t1'] == "hello world"
+
+def test_context_keyed_class(realm):
+    shared_class = keyed_context_class('TestSharedContext', {'app': None})
+    context_class = keyed_context_class('TestContext', {'count': int})
+    assert keyed_context_class('TestContext', {'count': int}) is context_class
+    shared = shared_class(None, None, {'app': "the app"})
+    context = context_class(None, shared, {'count': 1})
+    assert context.count == 1
+    context.count = 2
+    with pytest.raises(TypeError):
+        context.count = "two"
+    with pytest.raises(TypeError):
+        context_class(None, None, {'count': "one"})
+    # a key the context doesn't have is looked up in its parents
+    shared_child = shared_class(None, shared)
+    assert shared_child.app == "the app"
+    del context.count
+    with pytest.raises(AttributeError):
+        _ = context.count
+    context.count = 3
+    context2 = pickle.loads(pickle.dumps(context))
+    assert type(context2) is context_class
+    assert context2.count == 3 and context2._parent_hd.app == "the app"
+
+def _chain(depth):
+    context = SanicContext(None, None, {'root_key': 0})
+    for _ in range(depth - 1):
+        context = context.create_child_context()
+    return context
+
+def _best_time(func, min_time=0.002):
+    # A quick version of benchmarks/context_complexity.py, enough to tell O(n) from O(n^2)
+    timer = Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:
+        number *= 2
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+def _fit_exponent(sizes, seconds):
+    xs = [math.log(n) for n in sizes]
+    ys = [math.log(t) for t in seconds]
+    x_mean = sum(xs) / len(xs)
+    y_mean = sum(ys) / len(ys)
+    covariance = sum((x - x_mean) * (y - y_mean) for x, y in zip(xs, ys))
+    return covariance / sum((x - x_mean) ** 2 for x in xs)
+
+def test_context_get_inherited_scales_linearly():
+    sizes = (100, 400, 1600)
+    seconds = []
+    for n in sizes:
+        context = _chain(n)
+
+        def get_uncached():
+            # a new generation throws away the lookup cache, so this walks every parent
+            HierDict._generation += 1
+            return context['root_key']
+
+        seconds.append(_best_time(get_uncached))
+    assert _fit_exponent(sizes, seconds) < 1.5
+
+def test_context_get_cached_is_constant():
+    sizes = (25, 100, 400)
+    seconds = []
+    for n in sizes:
+        context = _chain(n)
+        seconds.append(_best_time(lambda: context['root_key']))
+    assert _fit_exponent(sizes, seconds) < 0.5
@@ -1,4 +1,11 @@
-from sanic import Sanic
+import asyncio
+import time
+
+from functools import wraps
+
+import pytest
+
+from sanic import Blueprint, Sanic
 from sanic.exceptions import NotFound
 from sanic.request import Request
 from sanic.response import HTTPResponse, text
@@ -166,3 +173,680 @@ def test_middleware_order(realm):
 
     assert response.status == 200
     assert order == [1, 2, 3, 4, 5, 6]
+
+
+def test_middleware_order_with_app_and_named_middleware(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    bp = Blueprint('test_bp', url_prefix='/bp')
+    order = []
+
+    @plugin.middleware('request', relative='pre')
+    async def pre_request(request):
+        order.append('pre_request')
+
+    @plugin.middleware('request', relative='post')
+    async def post_request(request):
+        order.append('post_request')
+
+    @plugin.middleware('response', relative='pre')
+    async def pre_response(request, response):
+        order.append('pre_response')
+
+    @plugin.middleware('response', relative='post')
+    async def post_response(request, response):
+        order.append('post_response')
+
+    @app.middleware('request')
+    async def app_request(request):
+        order.append('app_request')
+
+    @app.middleware('response')
+    async def app_response(request, response):
+        order.append('app_response')
+
+    @bp.middleware('request')
+    async def bp_request(request):
+        order.append('bp_request')
+
+    @bp.middleware('response')
+    async def bp_response(request, response):
+        order.append('bp_response')
+
+    @bp.route('/')
+    async def bp_handler(request):
+        return text('BP')
+
+    @app.route('/')
+    async def handler(request):
+        return text('OK')
+
+    app.blueprint(bp)
+    realm.register_plugin(plugin)
+    client = app._test_manager.test_client
+    _, response = client.get('/')
+    assert response.text == 'OK'
+    assert order == ['pre_request', 'app_request', 'post_request', 'pre_response', 'app_response', 'post_response']
+    del order[:]
+    _, response = client.get('/bp/')
+    assert response.text == 'BP'
+    assert order == [
+        'pre_request',
+        'app_request',
+        'bp_request',
+        'post_request',
+        'pre_response',
+        'app_response',
+        'bp_response',
+        'post_response',
+    ]
+
+
+def test_middleware_app_middleware_registered_at_startup(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    results = []
+
+    @plugin.middleware
+    def plugin_request(request):
+        results.append('plugin_request')
+
+    def late_request(request):
+        results.append('late_request')
+
+    def late_response(request, response):
+        results.append('late_response')
+
+    @app.listener('before_server_start')
+    async def add_middleware(app, loop):
+        # runs after the realm's own before_server_start listener
+        app.register_middleware(late_request, 'request')
+        app.register_middleware(late_response, 'response')
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    _, response = app._test_manager.test_client.get('/')
+    assert response.text == 'OK'
+    assert results == ['plugin_request', 'late_request', 'late_response']
+
+
+def test_middleware_sync_async_and_wrapped(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    order = []
+
+    def wrap(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            # a sync wrapper that returns the coroutine of an async middleware
+            return f(*args, **kwargs)
+
+        return wrapper
+
+    @plugin.middleware(priority=1)
+    def sync_request(request):
+        order.append('sync')
+
+    @plugin.middleware(priority=2, with_context=True)
+    async def async_context_request(request, context):
+        order.append('async_context')
+
+    @plugin.middleware(priority=3)
+    @wrap
+    async def wrapped_request(request):
+        order.append('wrapped')
+
+    @plugin.middleware(attach_to='cleanup')
+    def sync_cleanup(request):
+        order.append('cleanup')
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    _, response = app._test_manager.test_client.get('/')
+    assert response.text == 'OK'
+    assert order == ['sync', 'async_context', 'wrapped', 'cleanup']
+    chain = realm._get_plugin_middleware_chain('pre_request', None)
+    assert [awaits for (_m, awaits) in chain] == [None, True, None]
+
+
+def test_middleware_sync_lambda_returning_coroutine(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    order = []
+
+    async def record(name):
+        order.append(name)
+
+    plugin.middleware(lambda request: record('plugin_request'))
+    plugin.middleware(attach_to='response')(lambda request, response: record('plugin_response'))
+    app.middleware('request')(lambda request: record('app_request'))
+    app.middleware('response')(lambda request, response: record('app_response'))
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    _, response = app._test_manager.test_client.get('/')
+    assert response.text == 'OK'
+    assert sorted(order) == ['app_request', 'app_response', 'plugin_request', 'plugin_response']
+
+
+def test_middleware_include_exclude(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    results = []
+
+    @plugin.middleware(include='/api')
+    def api_only(request):
+        results.append(('api_only', request.path))
+
+    @plugin.middleware(exclude='/health')
+    def not_health(request):
+        results.append(('not_health', request.path))
+
+    @plugin.middleware(exclude=['/api', 'POST'])
+    def not_api_post(request):
+        results.append(('not_api_post', request.path))
+
+    @plugin.middleware(attach_to='response', include=['TestPlugin.health'])
+    def health_response(request, response):
+        results.append(('health_response', request.path))
+
+    @plugin.route('/api/items/<item_id>', methods=['GET', 'POST'])
+    async def items(request, item_id):
+        return text('items')
+
+    @plugin.route('/apiv2')
+    async def apiv2(request):
+        return text('apiv2')
+
+    @plugin.route('/health')
+    async def health(request):
+        return text('health')
+
+    realm.register_plugin(plugin)
+    client = app._test_manager.test_client
+    client.get('/api/items/1')
+    assert results == [('api_only', '/api/items/1'), ('not_health', '/api/items/1'), ('not_api_post', '/api/items/1')]
+    del results[:]
+    client.post('/api/items/1')
+    assert results == [('api_only', '/api/items/1'), ('not_health', '/api/items/1')]
+    del results[:]
+    client.get('/apiv2')
+    assert results == [('not_health', '/apiv2'), ('not_api_post', '/apiv2')]
+    del results[:]
+    client.get('/health')
+    assert results == [('not_api_post', '/health'), ('health_response', '/health')]
+    del results[:]
+    client.get('/api/not_found')
+    assert results == [
+        ('api_only', '/api/not_found'),
+        ('not_health', '/api/not_found'),
+        ('not_api_post', '/api/not_found'),
+    ]
+    # the other middleware are left out of the chain completely for the health route
+    chain = realm._get_plugin_middleware_chain('pre_request', 'TestPlugin.health')
+    assert [m for (m, _awaits) in chain] == [not_api_post]
+
+
+def test_middleware_route_rules_combine_kinds():
+    from types import SimpleNamespace
+
+    from sanic_plugin_toolkit.middleware import RouteRules
+
+    # In one list, a route must match a prefix or name, and a method
+    rules = RouteRules(['/api/public', 'TestPlugin.status', 'OPTIONS'])
+
+    def request(path, method, name=None):
+        return SimpleNamespace(path=path, method=method, name=name)
+
+    assert rules.match_request(request('/api/public/docs', 'OPTIONS'))
+    assert not rules.match_request(request('/api/public/docs', 'GET'))
+    assert not rules.match_request(request('/api/private', 'OPTIONS'))
+    assert rules.match_request(request('/status', 'OPTIONS', 'app.TestPlugin.status'))
+    assert not rules.match_request(request('/status', 'GET', 'app.TestPlugin.status'))
+    route = SimpleNamespace(name='app.TestPlugin.public', uri='/api/public/<doc>', methods={'GET', 'OPTIONS'})
+    # decided per request, by the method
+    assert rules.match_route(route) is None
+    assert rules.match_route(SimpleNamespace(name=route.name, uri=route.uri, methods={'GET'})) is False
+
+
+def test_middleware_concurrent_group(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    started = []
+    finished = []
+    # name -> (start, end) of each run of a group member
+    spans = {}
+
+    @plugin.middleware(priority=4)
+    def before(request):
+        started.append('before')
+
+    @plugin.middleware(priority=5, concurrent=True)
+    async def flags(request):
+        started.append('flags')
+        start = time.monotonic()
+        await asyncio.sleep(0.02)
+        spans['flags'] = (start, time.monotonic())
+        finished.append('flags')
+
+    @plugin.middleware(priority=5, concurrent=True)
+    async def tenant(request):
+        started.append('tenant')
+        start = time.monotonic()
+        await asyncio.sleep(0.02)
+        spans['tenant'] = (start, time.monotonic())
+        finished.append('tenant')
+        if request.path == '/blocked':
+            return text('BLOCKED', status=403)
+
+    @plugin.middleware(priority=5, concurrent=True)
+    async def session(request):
+        started.append('session')
+        start = time.monotonic()
+        await asyncio.sleep(0.01)
+        spans['session'] = (start, time.monotonic())
+        finished.append('session')
+
+    @plugin.middleware(priority=6)
+    def after(request):
+        started.append('after')
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    @plugin.route('/blocked')
+    async def blocked(request):
+        return text('FAIL')
+
+    realm.register_plugin(plugin)
+    client = app._test_manager.test_client
+    _, response = client.get('/')
+    assert response.text == 'OK'
+    assert started == ['before', 'flags', 'tenant', 'session', 'after']
+    assert finished == ['session', 'flags', 'tenant']
+    # every member started before any of them ended, so they all ran at once
+    assert max(start for (start, _end) in spans.values()) < min(end for (_start, end) in spans.values())
+    chain = realm._get_plugin_middleware_chain('pre_request', None)
+    assert len(chain) == 3
+    del started[:]
+    del finished[:]
+    _, response = client.get('/blocked')
+    assert response.status == 403
+    assert response.text == 'BLOCKED'
+    # every member of the group finishes, but the chain stops after the group
+    assert started == ['before', 'flags', 'tenant', 'session']
+    assert len(finished) == 3
+
+
+def test_middleware_concurrent_only_for_request(realm):
+    plugin = TestPlugin()
+
+    @plugin.middleware(attach_to='response', concurrent=True)
+    async def response_mw(request, response):
+        pass
+
+    with pytest.raises(AssertionError):
+        realm.register_plugin(plugin)
+
+
+def test_middleware_after_response(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    results = []
+    events = {}
+
+    @plugin.middleware(attach_to='after_response', with_context=True)
+    async def after_mw(request, response, context):
+        # Held until the server is stopping, so the response must have been sent already
+        await events['stopping'].wait()
+        shared_request = context.shared.request[id(request)]
+        results.append((response.status, shared_request.get('seen')))
+
+    @plugin.middleware(attach_to='after_response')
+    def failing_after_mw(request, response):
+        raise RuntimeError("logged, not raised")
+
+    @plugin.middleware(attach_to='after_response', priority=6)
+    def last_after_mw(request, response):
+        results.append('last')
+
+    @plugin.route('/', with_context=True)
+    async def handler(request, context):
+        events['stopping'] = asyncio.Event()
+        context.shared.request[id(request)]['seen'] = True
+        return text('OK')
+
+    @app.listener('before_server_stop')
+    async def release_after_response(app, loop):
+        # Stop listeners run last-registered first, so this runs before the realm drains its runner
+        results.append('stopping')
+        events['stopping'].set()
+
+    realm.register_plugin(plugin)
+    request, response = app.test_client.get('/')
+    assert response.text == 'OK'
+    assert results == ['stopping', (200, True), 'last']
+    assert id(request) not in realm.shared_context.request
+
+
+def test_middleware_after_response_blueprint_full(realm_bp):
+    realm, app = realm_bp
+    app.config['SPTK_AFTER_RESPONSE_MAX_TASKS'] = 1
+    plugin = TestPlugin()
+    results = []
+    events = {}
+
+    @plugin.middleware(attach_to='after_response')
+    def after_mw(request, response):
+        results.append('after')
+
+    async def blocker():
+        await events['stopping'].wait()
+
+    @plugin.route('/')
+    async def handler(request):
+        # Take the only slot, and the queue's only place
+        events['stopping'] = asyncio.Event()
+        runner = realm._after_response_runner
+        results.append((await runner.submit(blocker()), await runner.submit(blocker())))
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    app.blueprint(realm._app)
+
+    # Registered after the Blueprint's listeners, so it runs before the realm drains its runner
+    @app.listener('before_server_stop')
+    async def release_after_response(app, loop):
+        events['stopping'].set()
+
+    request, response = app.test_client.get('/blueprint/')
+    assert response.text == 'OK'
+    # The full pool dropped it, instead of running it before the response was sent
+    assert results == [(True, True)]
+    assert id(request) not in realm.shared_context.request
+
+
+# SanicPlugin.decorate() finds the plugin instance by its snake_case name in the module
+class DecoratedPlugin(SanicPlugin):
+    pass
+
+
+decorated_plugin = DecoratedPlugin()
+decorated_results = []
+
+
+@decorated_plugin.middleware(with_context=True)
+def decorated_request_mw(request, context):
+    decorated_results.append('request')
+
+
+@decorated_plugin.middleware(attach_to='cleanup')
+def decorated_cleanup_mw(request):
+    decorated_results.append('cleanup')
+
+
+class AfterResponsePlugin(SanicPlugin):
+    pass
+
+
+after_response_plugin = AfterResponsePlugin()
+
+
+@after_response_plugin.middleware(attach_to='after_response')
+def decorated_after_mw(request, response):
+    pass
+
+
+def test_decorate_runs_cleanup_middleware(app):
+    realm = SanicPluginRealm(app)
+    del decorated_results[:]
+
+    @app.route('/')
+    @DecoratedPlugin.decorate(app, run_middleware=True)
+    async def handler(request):
+        decorated_results.append('handler')
+        return text('OK')
+
+    _, response = app.test_client.get('/')
+    assert response.text == 'OK'
+    assert decorated_results == ['request', 'handler', 'cleanup']
+    assert realm.get_plugin_inst(decorated_plugin) is None
+
+
+def test_decorate_keeps_middleware_options(app):
+    _ = SanicPluginRealm(app)
+    del decorated_results[:]
+
+    @app.route('/first')
+    @DecoratedPlugin.decorate(app, run_middleware=True)
+    async def first(request):
+        return text('first')
+
+    # The second route gets the plugin's middleware with the same options, like with_context
+    @app.route('/second')
+    @DecoratedPlugin.decorate(app, run_middleware=True)
+    async def second(request):
+        return text('second')
+
+    options = [(m.kwargs['attach_to'], m.kwargs['with_context']) for m in decorated_plugin._middlewares]
+    assert options == [(None, True), ('cleanup', False)]
+    _, response = app.test_client.get('/second')
+    assert response.text == 'second'
+    assert decorated_results == ['request', 'cleanup']
+
+
+def test_decorate_rejects_after_response_middleware(app):
+    _ = SanicPluginRealm(app)
+    with pytest.raises(AssertionError):
+        AfterResponsePlugin.decorate(app, run_middleware=True)
+
+
+def test_middleware_cleanup_in_background(realm):
+    app = realm._app
+    app.config['SPTK_CLEANUP_MAX_TASKS'] = 2
+    plugin = TestPlugin()
+    results = []
+    events = {}
+
+    @plugin.middleware(attach_to='cleanup', with_context=True)
+    async def cleanup_mw(request, context):
+        # Held until the server is stopping, so it can't be holding up the response
+        await events['stopping'].wait()
+        # The request context is still here while the cleanup runs
+        results.append(context.shared.request[id(request)].get('seen'))
+
+    @plugin.route('/', with_context=True)
+    async def handler(request, context):
+        events['stopping'] = asyncio.Event()
+        context.shared.request[id(request)]['seen'] = True
+        return text('OK')
+
+    @app.listener('before_server_stop')
+    async def release_cleanup(app, loop):
+        # Stop listeners run last-registered first, so this runs before the realm drains its runner
+        results.append('stopping')
+        events['stopping'].set()
+
+    realm.register_plugin(plugin)
+    request, response = app.test_client.get('/')
+    assert response.text == 'OK'
+    assert results == ['stopping', True]
+    assert id(request) not in realm.shared_context.request
+
+
+def test_background_runner_overflow():
+    from sanic_plugin_toolkit.middleware import BackgroundRunner
+
+    results = []
+
+    async def work(n):
+        await asyncio.sleep(0.01)
+        results.append(n)
+
+    async def run(overflow):
+        runner = BackgroundRunner(1, max_queued=1, overflow=overflow)
+        submitted = [await runner.submit(work(n)) for n in range(3)]
+        results.append('submitted')
+        await runner.drain()
+        return submitted
+
+    assert asyncio.run(run('drop')) == [True, True, False]
+    assert results == ['submitted', 0, 1]
+    results.clear()
+    assert asyncio.run(run('inline')) == [True, True, True]
+    # the overflowing one was awaited by the caller
+    assert results.index(2) < results.index('submitted') < results.index(1)
+    results.clear()
+    assert asyncio.run(run('block')) == [True, True, True]
+    assert results == [0, 'submitted', 1, 2]
+
+
+def test_middleware_timeout(realm):
+    app = realm._app
+    plugin = TestPlugin()
+    results = []
+
+    @plugin.middleware(timeout=0.01, on_timeout='skip')
+    async def slow_skipped(request):
+        await asyncio.sleep(1)
+        results.append('not skipped')
+        return text('not skipped')
+
+    @plugin.middleware(priority=6, timeout=0.01, on_timeout='503', include='/unavailable')
+    async def slow_unavailable(request):
+        await asyncio.sleep(1)
+
+    @plugin.middleware(priority=7, timeout=1)
+    async def fast(request):
+        results.append('fast')
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    @plugin.route('/unavailable')
+    async def unavailable(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    request, response = app.test_client.get('/')
+    assert response.text == 'OK'
+    assert results == ['fast']
+    request, response = app.test_client.get('/unavailable')
+    assert response.status == 503
+
+
+def test_middleware_timeout_options(realm):
+    plugin = TestPlugin()
+
+    @plugin.middleware(attach_to='response', on_timeout='503', timeout=1)
+    async def response_mw(request, response):
+        pass
+
+    with pytest.raises(AssertionError):
+        realm.register_plugin(plugin)
+
+
+def test_middleware_budget(realm):
+    app = realm._app
+    app.config['SPTK_MIDDLEWARE_BUDGET'] = 0.05
+    plugin = TestPlugin()
+    results = []
+
+    @plugin.middleware
+    async def first(request):
+        await asyncio.sleep(0.03)
+        results.append('first')
+
+    @plugin.middleware(priority=6)
+    async def second(request):
+        await asyncio.sleep(1)
+
+    @plugin.middleware(priority=7)
+    def third(request):
+        results.append('third')
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    request, response = app.test_client.get('/')
+    assert response.status == 503
+    # The second one used up the rest of the budget, the third never ran
+    assert results == ['first']
+
+
+def test_middleware_budget_on_timeout_checked(realm):
+    app = realm._app
+    app.config['SPTK_MIDDLEWARE_BUDGET'] = 0.05
+    app.config['SPTK_MIDDLEWARE_BUDGET_ON_TIMEOUT'] = 'sikp'
+    realm.register_plugin(TestPlugin())
+    with pytest.raises(AssertionError):
+        realm._compile_plugin_middleware_chains(app)
+
+
+def test_middleware_stats(realm):
+    app = realm._app
+    app.config['SPTK_MIDDLEWARE_STATS'] = True
+    plugin = TestPlugin()
+
+    @plugin.middleware
+    async def counted(request):
+        await asyncio.sleep(0.002)
+
+    @plugin.middleware(attach_to='response')
+    def failing(request, response):
+        if request.path == '/fail':
+            raise RuntimeError("counted as an error")
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    @plugin.route('/fail')
+    async def fail(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    assert realm.stats() == []
+    app.test_client.get('/')
+    app.test_client.get('/fail')
+    stats = {s['middleware']: s for s in realm.stats()}
+    assert stats['counted']['plugin'] == 'TestPlugin'
+    assert stats['counted']['phase'] == 'pre_request'
+    assert stats['counted']['count'] == 2
+    assert stats['counted']['errors'] == 0
+    assert stats['counted']['total_time'] >= 0.004
+    assert sum(c for (_bound, c) in stats['counted']['histogram']) == 2
+    assert stats['failing']['phase'] == 'post_response'
+    assert (stats['failing']['count'], stats['failing']['errors']) == (2, 1)
+
+
+def test_middleware_stats_off(realm):
+    app = realm._app
+    plugin = TestPlugin()
+
+    @plugin.middleware
+    def not_counted(request):
+        pass
+
+    @plugin.route('/')
+    async def handler(request):
+        return text('OK')
+
+    realm.register_plugin(plugin)
+    app.test_client.get('/')
+    assert realm.stats() == []
+    # the middleware is in the chain as it is, without a wrapper
+    assert realm._get_plugin_middleware_chain('pre_request', None) == ((not_counted, None),)
@@ -67,3 +67,26 @@ def test_plugiun_class_registration(realm):
     (plugin, reg) = reg
     assert isinstance(reg, PluginRegistration)
     assert plugin == test_plugin2
+
+class KeyedPlugin(SanicPlugin):
+    context_keys = {'db_pool': dict, 'token': None}
+
+keyed_plugin = KeyedPlugin()
+
+def test_plugin_context_keys(realm):
+    realm.register_plugin(keyed_plugin)
+    context = realm.get_context('KeyedPlugin')
+    assert 'db_pool' in type(context).__dict__ and 'shared' in type(context).__dict__
+    context.db_pool = {'size': 4}
+    context.token = 1
+    assert context.db_pool == {'size': 4} and context['token'] == 1
+    exc = None
+    try:
+        context['db_pool'] = "not a pool"
+    except TypeError as e:
+        exc = e
+    assert exc is not None
+    assert context.shared.app is realm._app
+    assert 'app' in type(context.shared).__dict__
+    del context.token
+    assert context.get('token') is None
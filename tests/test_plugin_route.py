@@ -1,8 +1,11 @@
+import gc
+
 from urllib.parse import urlparse
 
 import pytest
 
 from sanic import Sanic
+from sanic.request import Request
 from sanic.response import text
 
 from sanic_plugin_toolkit import SanicPlugin, SanicPluginRealm
@@ -87,3 +90,283 @@ def test_plugin_route_context(realm):
     realm.register_plugin(test_plugin)
     request, response = app._test_manager.test_client.get('/')
     assert response.text == "OK"
+
+
+def test_plugin_route_private_request_context_is_lazy(realm):
+    app = realm._app
+    used_plugin = TestPlugin()
+    unused_plugin = TestPlugin()
+    results = []
+
+    @used_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        assert id(request) in context.request
+        anchor = request.ctx._sptk_request_contexts[id(realm)]
+        results.append(list(anchor.private))
+        priv_request = context.for_request(request)
+        assert priv_request.get('request') is request
+        assert context.request[id(request)] is priv_request
+        results.append([p_request for (p_request, _c) in anchor.private])
+        return text('OK')
+
+    realm.register_plugin(used_plugin)
+    realm.register_plugin(unused_plugin, name='UnusedPlugin')
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "OK"
+    # nothing was created until the route looked it up, and only for its own plugin
+    assert results[0] == []
+    assert results[1] == [realm.get_context('TestPlugin').request]
+    assert id(request) not in realm.get_context('UnusedPlugin').request
+    assert request.ctx._sptk_request_contexts == {}
+    assert len(realm.get_context('TestPlugin').request) == 1  # only the 'id'
+
+
+def test_plugin_route_request_contextvars(realm):
+    app = realm._app
+    app.config['SPTK_REQUEST_CONTEXTVARS'] = True
+    test_plugin = TestPlugin()
+    results = []
+
+    @test_plugin.middleware(with_context=True)
+    def mw(request, context):
+        context.for_request(request)['seen'] = True
+        context.shared.request[id(request)]['shared_seen'] = True
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        shared_request = context.shared.request[id(request)]
+        priv_request = context.for_request(request)
+        assert id(request) in context.request
+        assert shared_request.get('request') is request
+        assert priv_request.get('request') is request
+        results.append((shared_request.get('shared_seen'), priv_request.get('seen')))
+        # nothing is stored per request in the dicts, the realm only counts them
+        results.append(len(context.shared.request) + len(context.request))
+        results.append((realm.live_request_contexts(), len(realm._live_request_contexts)))
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "OK"
+    assert results == [(True, True), 2, (1, 0)]
+    assert realm.live_request_contexts() == 0
+    assert realm._request_context_var.get() is None
+    with pytest.raises(KeyError):
+        _ = realm.get_context('TestPlugin').request[id(request)]
+
+
+def test_plugin_route_request_context_pool(realm):
+    app = realm._app
+    app.config['SPTK_REQUEST_CONTEXT_POOL_SIZE'] = 4
+    app.config['SPTK_REQUEST_CONTEXT_POOL_DEBUG'] = True
+    test_plugin = TestPlugin()
+    contexts = []
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        priv_request = context.for_request(request)
+        assert 'seen' not in priv_request
+        priv_request['seen'] = True
+        contexts.append(priv_request)
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    client = app._test_manager.test_client
+    request, response = client.get('/')
+    assert response.text == "OK"
+    first = contexts[0]
+    with pytest.raises(RuntimeError):
+        _ = first['seen']
+    # both request contexts went back to the pool
+    pooled = list(realm._request_context_pool._free)
+    assert len(pooled) == 2
+    request, response = client.get('/')
+    assert response.text == "OK"
+    assert any(c is contexts[1] for c in pooled)
+
+
+def test_plugin_route_shared_request_context_keys(realm):
+    app = realm._app
+    app.config['SPTK_REQUEST_CONTEXT_SHARED_KEYS'] = True
+    test_plugin = TestPlugin()
+    results = []
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        priv_request = context.for_request(request)
+        assert 'seen' not in priv_request
+        priv_request['seen'] = True
+        shared_request = context.shared.request[id(request)]
+        results.append((type(priv_request._inner()).__name__, type(shared_request._inner()).__name__))
+        results.append((priv_request['request'] is request, shared_request.request is request))
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    client = app._test_manager.test_client
+    for _ in range(2):
+        request, response = client.get('/')
+        assert response.text == "OK"
+    assert results[0] == results[2] == ('SharedKeyDict', 'SharedKeyDict')
+    assert results[1] == results[3] == (True, True)
+    layout = realm._request_context_layouts['TestPlugin']
+    assert layout._keys == ['request', 'id', 'seen']
+
+
+def test_plugin_route_declared_request_context(realm):
+    app = realm._app
+
+    class DeclaredPlugin(SanicPlugin):
+        class RequestContext:
+            __slots__ = ('user', 'token')
+
+    declared_plugin = DeclaredPlugin()
+    results = []
+
+    @declared_plugin.middleware(with_context=True)
+    def mw(request, context):
+        priv_request = context.for_request(request)
+        assert 'user' not in priv_request
+        priv_request.user = "alice"
+        priv_request['token'] = "abc"
+        priv_request.extra = 1
+
+    @declared_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        priv_request = context.for_request(request)
+        results.append((priv_request['user'], priv_request.token, priv_request.get('extra')))
+        # only the undeclared key is in the fallback dict
+        results.append(dict(priv_request._inner()))
+        results.append(priv_request.get('request') is request)
+        return text('OK')
+
+    realm.register_plugin(declared_plugin)
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "OK"
+    assert results == [("alice", "abc", 1), {'extra': 1}, True]
+
+
+def test_plugin_route_orphaned_request_contexts(realm):
+    app = realm._app
+    test_plugin = TestPlugin()
+    kept = []
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        context.for_request(request)['seen'] = True
+        # Like a response path that never runs, the contexts are not deleted
+        realm.create_temporary_request_context(kept[0])
+        _ = context.request[id(kept[0])]  # noqa: F841
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    client = app._test_manager.test_client
+    kept.append(Request(b'/orphan', {}, '1.1', 'GET', None, app))
+    request, response = client.get('/')
+    assert response.text == "OK"
+    assert realm.live_request_contexts() == 1
+    assert id(kept[0]) in realm.get_context('TestPlugin').request
+    # Still too young to be swept
+    assert realm.sweep_request_contexts(60.0) == 0
+    assert realm.sweep_request_contexts(0.0) == 1
+    assert realm.live_request_contexts() == 0
+    assert id(kept[0]) not in realm.get_context('TestPlugin').request
+    # Without a sweep, they go away with the request itself
+    realm.create_temporary_request_context(kept[0])
+    assert realm.live_request_contexts() == 1
+    del kept[:]
+    gc.collect()
+    assert realm.live_request_contexts() == 0
+
+
+def test_plugin_route_sweep_skips_requests_in_flight(realm):
+    app = realm._app
+    test_plugin = TestPlugin()
+    results = []
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        context.for_request(request)['seen'] = True
+        # A long running request is older than max_age, but it is still being handled
+        results.append(realm.sweep_request_contexts(0.0))
+        results.append(context.for_request(request).get('seen'))
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "OK"
+    assert results == [0, True]
+    assert realm._requests_in_flight == set()
+    assert realm.live_request_contexts() == 0
+
+
+def test_plugin_route_no_sweep_on_blueprint(realm_bp):
+    realm, app = realm_bp
+    app.config['SPTK_REQUEST_CONTEXT_SWEEP_INTERVAL'] = 0.01
+    test_plugin = TestPlugin()
+    results = []
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        context.for_request(request)['seen'] = True
+        # The Blueprint can't tell this request is still running, so it never sweeps
+        results.append(realm._request_context_sweeper)
+        results.append(realm.sweep_request_contexts(0.0))
+        results.append(context.for_request(request).get('seen'))
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    app.blueprint(realm._app)
+    request, response = app._test_manager.test_client.get('/blueprint/')
+    assert response.text == "OK"
+    assert results == [None, 0, True]
+
+
+def test_plugin_route_detach_request_context(realm):
+    app = realm._app
+    app.config['SPTK_REQUEST_CONTEXT_POOL_SIZE'] = 4
+    test_plugin = TestPlugin()
+
+    @test_plugin.route('/', with_context=True)
+    async def handler(request, context):
+        return text('OK')
+
+    realm.register_plugin(test_plugin)
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "OK"
+    # A handler that starts a background task, outside of the server
+    context = realm.get_context('TestPlugin')
+    request = Request(b'/', {}, '1.1', 'GET', None, app)
+    realm.create_temporary_request_context(request)
+    context.shared.request[id(request)]['user'] = "alice"
+    context.for_request(request)['cache_key'] = "k1"
+    shared_snap = realm.detach_request_context(request)
+    priv_snap = context.for_request(request).snapshot()
+    realm.delete_temporary_request_context(request)
+    # the request contexts were deleted and cleared for the pool, the snapshots still work
+    assert len(realm._request_context_pool) == 2
+    assert realm.live_request_contexts() == 0
+    assert shared_snap['user'] == "alice"
+    assert priv_snap['cache_key'] == "k1"
+    assert priv_snap['request'] is request
+    with pytest.raises(KeyError):
+        realm.detach_request_context(request)
+
+
+def test_plugin_route_frozen_contexts(realm):
+    app = realm._app
+    test_plugin = TestPlugin()
+    views = {}
+
+    @test_plugin.route('/')
+    async def handler(request):
+        context = views['TestPlugin']
+        assert context.for_request(request).get('request') is request
+        return text(context.shared.get('greeting'))
+
+    realm.register_plugin(test_plugin)
+    realm.shared_context['greeting'] = "hello"
+    views.update(realm.freeze_contexts())
+    assert views['shared']['greeting'] == "hello"
+    assert views['TestPlugin'].greeting == "hello"
+    request, response = app._test_manager.test_client.get('/')
+    assert response.text == "hello"
@@ -0,0 +1,136 @@
+import multiprocessing
+import os
+
+from array import array
+
+import pytest
+
+from sanic.response import text
+
+from sanic_plugin_toolkit import SanicPlugin
+from sanic_plugin_toolkit.shared_buffers import SharedBuffers
+
+
+pytest.importorskip('multiprocessing.shared_memory')
+
+
+class TablePlugin(SanicPlugin):
+    pass
+
+
+def _read_in_child(realm, name, queue):
+    queue.put(list(realm.get_context().buffers[name]))
+
+
+def test_shared_buffer_publish_and_read(realm):
+    realm.register_plugin(TablePlugin())
+    context = realm.get_context('TablePlugin')
+    version = realm.publish_shared_buffer('ranges', array('I', [1, 2, 3]))
+    assert version == 1
+    view = context.shared.buffers['ranges']
+    assert view.format == 'I' and list(view) == [1, 2, 3]
+    assert view.readonly
+    assert realm.shared_buffer('ranges') is view
+    assert 'ranges' in context.shared.buffers and 'missing' not in context.shared.buffers
+    with pytest.raises(KeyError):
+        _ = realm.shared_buffer('missing')
+    # another process, with the same token, reads the same memory
+    other = SharedBuffers(context.shared.buffers.token)
+    assert list(other['ranges']) == [1, 2, 3]
+    assert realm.publish_shared_buffer('ranges', b'\x01\x02', format='B') == 2
+    assert other.version('ranges') == 2
+    assert bytes(other['ranges']) == b'\x01\x02'
+    # the old view still works, its memory is freed once it is released
+    assert list(view) == [1, 2, 3]
+    view.release()
+    realm._shared_buffers.unlink()
+    assert other.version('ranges') == 2
+    assert 'ranges' not in SharedBuffers(context.shared.buffers.token)
+
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+def test_shared_buffer_in_worker_process(realm):
+    realm.publish_shared_buffer('flags', b'\x00\x01\x01')
+    mp = multiprocessing.get_context('fork')
+    queue = mp.Queue()
+    worker = mp.Process(target=_read_in_child, args=(realm, 'flags', queue))
+    worker.start()
+    try:
+        assert queue.get(timeout=10) == [0, 1, 1]
+    finally:
+        worker.join()
+        realm._shared_buffers.unlink()
+
+
+def test_shared_buffer_bad_format(realm):
+    with pytest.raises(ValueError):
+        realm.publish_shared_buffer('bad', b'\x00' * 8, format='<d')
+    with pytest.raises(AssertionError):
+        realm.publish_shared_buffer('bad', b'\x00' * 6, format='I')
+    realm._shared_buffers.unlink()
+
+
+def test_shared_buffer_unlink_releases_views(realm):
+    realm.publish_shared_buffer('ids', array('I', [7, 8]))
+    view = realm.shared_buffer('ids')
+    realm._shared_buffers.unlink()
+    with pytest.raises(ValueError):
+        _ = view[0]
+    # nothing was left open
+    assert realm._shared_buffers._retired == []
+
+
+def test_shared_buffer_publish_race(realm, monkeypatch):
+    from sanic_plugin_toolkit import shared_buffers
+
+    buffers = realm._shared_buffers
+    other = SharedBuffers(buffers.token)
+    assert buffers.publish('table', b'\x01') == 1
+    header = shared_buffers._HEADER
+
+    class RacingHeader(object):
+        size = header.size
+
+        def pack_into(self, *args):
+            # another process publishes while this one is writing version 2, and takes version 3
+            monkeypatch.setattr(shared_buffers, '_HEADER', header)
+            assert other.publish('table', b'\x03') == 3
+            header.pack_into(*args)
+
+    monkeypatch.setattr(shared_buffers, '_HEADER', RacingHeader())
+    # the pointer doesn't go back to version 2, the newer version wins
+    assert buffers.publish('table', b'\x02') == 3
+    assert bytes(buffers['table']) == b'\x03'
+    assert 'table' in other
+    # the losing and replaced versions were unlinked
+    for version in (1, 2):
+        with pytest.raises(FileNotFoundError):
+            shared_buffers.shared_memory.SharedMemory(buffers._segment_name('table', version))
+    other.unlink()
+    buffers.unlink()
+
+
+def test_shared_buffer_unlinked_when_blueprint_app_stops(realm_bp):
+    realm, app = realm_bp
+    realm.publish_shared_buffer('bp_table', b'\x01')
+    app.blueprint(realm._app)
+    assert realm._on_main_process_stop in app.listeners['main_process_stop']
+    realm._on_main_process_stop(app, None)
+    assert 'bp_table' not in SharedBuffers(realm._shared_buffers.token)
+
+
+def test_shared_buffer_published_while_serving(realm):
+    app = realm._app
+    realm.register_plugin(TablePlugin())
+    versions = []
+
+    @app.route('/')
+    async def handler(request):
+        versions.append(realm.publish_shared_buffer('live', b'\x01\x02'))
+        return text(str(bytes(realm.shared_buffer('live'))))
+
+    _, response = app.test_client.get('/')
+    assert versions == [1]
+    # freed when the worker stopped
+    assert 'live' not in SharedBuffers(realm._shared_buffers.token)
+    assert realm._serving_buffer_names == set()